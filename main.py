@@ -6,10 +6,30 @@ Enhanced version with aggressive metadata removal including compressor/vendor in
 """
 
 import os
+import argparse
+import asyncio
+import contextvars
+import csv
+import fnmatch
+import hashlib
+import json
 import random
+import shlex
+import shutil
+import signal
+import sys
+import socket
+import socketserver
+import sqlite3
+import struct
 import subprocess
+import tempfile
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, replace
 from pathlib import Path
 
 # Setup logging
@@ -65,6 +85,7 @@ switches = {
     "aggressive_metadata_removal": True,  # New option
     "force_reencoding": True,  # Force re-encoding to remove embedded metadata
     "force_vendor_patch": True,  # After mux, patch MOV vendor 'FFMP' -> 'appl'
+    "remux_fast_path": False,  # No pixel/sample filters active -> stream copy + metadata/SEI scrub, no re-encode
 }
 
 # Output mode: 'h264' (libx264), 'hevc' (libx265), or 'prores_apple' (ProRes with Apple vendor)
@@ -76,23 +97,583 @@ prores_encoder = 'prores_ks'   # use prores_ks by default; some builds honor ven
 prores_profile = '3'           # 0=proxy,1=lt,2=standard,3=hq,4=4444,5=4444xq (for prores_ks). '3' ~ HQ
 prores_fourcc = 'apch'         # apcn=422 standard, apch=422 HQ, ap4h=4444, etc.
 prores_qscale = '9'            # quality scale for prores_ks; prores_aw uses -qscale as well
+encoder_preset = 'ultrafast'   # x264/x265 preset
+optimize_filters = True        # rewrite the -vf chain into a cheaper equivalent (see optimize_filter_ops)
+# How the MOV is written (see MUX_MODE_MOVFLAGS): 'legacy' keeps the original +faststart+empty_moov
+# (empty_moov makes the muxer fragment, so faststart is ignored and the file is written in one pass),
+# 'faststart' moves moov to the front in a second pass over the file, 'fragmented' writes moof
+# fragments as it goes, 'reserved' leaves room for moov at the front, 'plain' writes moov at the end.
+output_mux_mode = 'legacy'
 
-def rv(param):
-    return round(random.uniform(params[param][0], params[param][1]), 4)
+# Batch scheduling: how many ffmpeg jobs run at once. 0 = auto (cores / threads_per_job_hint).
+# Each job gets an equal share of the cores via -threads so the total matches the machine.
+max_workers = 0
+dry_run = False                # print ffmpeg commands instead of running them
 
-def ri(param):
-    return random.randint(params[param][0], params[param][1])
+MUX_MODE_MOVFLAGS = {
+    "legacy": "+faststart+empty_moov",
+    "faststart": "+faststart",
+    "fragmented": "+frag_keyframe+empty_moov+default_base_moof",
+    "reserved": None,   # -moov_size sized per job, see estimate_moov_size
+    "plain": None,
+}
+# Sequential passes over the output per mode, for the I/O model: (extra reads, writes)
+MUX_MODE_PASSES = {"legacy": (0, 1), "faststart": (1, 2), "fragmented": (0, 1), "reserved": (0, 1), "plain": (0, 1)}
+
+# Remux fast path: source codec -> (MOV tag, bitstream filter dropping SEI NAL units such as
+# x264's user-data banner with its version and settings)
+REMUX_BITSTREAM_FILTERS = {
+    "h264": ("avc1", "filter_units=remove_types=6"),
+    "hevc": ("hvc1", "filter_units=remove_types=39|40"),
+}
+REMUX_AUDIO_COPY = {"aac"}   # audio codecs that are copied as-is; anything else is re-encoded to AAC
+# Encoder banners that must not survive in the output bitstream, and how far into the file to look
+ENCODER_BANNERS = (b"x264 - core", b"x265 (build", b"Lavc5", b"Lavc6")
+banner_scan_bytes = 8 * 1024 * 1024
+variants_per_input = 1         # >1: decode each input once and write N differently parameterised outputs
+
+# ffmpeg runs with -progress pipe:1; a job is killed only after stall_timeout seconds without progress
+stall_timeout = 60
+progress_print_interval = 5    # seconds between live progress lines per job
+stage_log_path = os.path.join(output_folder, "stage_timings.jsonl")
+
+# Segment-parallel encoding (opt-in) for long inputs: video is cut at keyframes, the segments are
+# encoded concurrently with the same resolved settings and joined losslessly with the concat demuxer.
+segment_parallel = False
+segment_min_duration = 120     # seconds of trimmed output before an input is split
+segment_target_seconds = 30    # approximate segment length
+segment_workers = 0            # concurrent segment encodes (0 = cores / threads_per_job_hint)
+
+# Adaptive preset controller (opt-in): set one target and the x264/x265 preset is chosen per job
+# as the slowest (best quality) one whose measured realtime factor still meets it.
+throughput_deadline_seconds = None  # finish the whole batch within this many seconds
+throughput_min_realtime = None      # or: every job must encode at least this many x realtime
+PRESET_LADDER = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"]
+# Rough speed relative to ultrafast, used for presets that haven't been measured yet
+PRESET_SPEED_PRIOR = {"ultrafast": 1.0, "superfast": 0.8, "veryfast": 0.55, "faster": 0.42,
+                      "fast": 0.33, "medium": 0.25, "slow": 0.15}
+
+# Admission control: an ffmpeg process only starts while the projected memory (and CPU) of the
+# running ones stays under the container's budget. Estimates come from the probe and are
+# corrected per codec/mode by the peak RSS jobs actually reached (persisted between runs).
+admission_control = True
+admission_memory_fraction = 0.85   # share of the memory limit encodes may use
+admission_cpu_overcommit = 1.5     # encoders rarely keep every thread busy
+admission_model_path = os.path.join(output_folder, ".admission_model.json")
+# codec -> (bytes per output pixel inside the encoder, frames it holds, CPU per thread)
+CODEC_FOOTPRINT = {
+    "h264": (1.5, 8, 1.0),
+    "hevc": (1.5, 48, 1.6),          # lookahead + frame threads
+    "prores_apple": (4.0, 8, 1.2),   # yuv422p10le
+}
+# ProRes packet size: bits per pixel per frame by profile, from Apple's target rates at 1080p29.97
+# (Proxy 45, LT 102, 422 147, HQ 220, 4444 330, 4444 XQ 500 Mbps)
+PRORES_BITS_PER_PIXEL = {'0': 0.72, '1': 1.64, '2': 2.36, '3': 3.54, '4': 5.31, '5': 8.04}
+
+# asyncio engine (--async): encodes run under a limit that follows the measured load average
+async_engine = False
+async_max_workers = 0          # upper bound for the adaptive limit (0 = 2x the initial worker count)
+async_load_target = (0.7, 1.1) # grow below / shrink above this 1-minute load per core
+async_adjust_interval = 10     # seconds between limit adjustments
+
+# Metrics: one JSON line per output, plus a Prometheus textfile-collector file (None to disable)
+metrics_jsonl_path = os.path.join(output_folder, "metrics.jsonl")
+prometheus_textfile_path = os.path.join(output_folder, "video_batch.prom")
+threads_per_job_hint = 4       # libx264 ultrafast on short 9:16 clips saturates ~4 threads
+
+# Persistent job manifest: re-runs only process new, changed or previously failed inputs
+incremental = True
+manifest_path = os.path.join(output_folder, "manifest.sqlite")
+# ffprobe results are kept in a probes table of the manifest database, one row per input path,
+# and reused while the file's size and mtime are unchanged so re-runs skip probing
+
+# Encode cache: byte-identical inputs with the same settings reuse (hardlink) an earlier output.
+# Opt-in: when on, every input is hashed and its random parameters are seeded from the content
+# hash so duplicates resolve to the same job (off keeps the unseeded per-run randomness).
+encode_cache_enabled = False
+encode_cache_dir = os.path.join(output_folder, ".encode_cache")
+encode_cache_max_bytes = 20 * 1024 ** 3  # LRU-evicted above this size
+
+# --benchmark: synthetic testsrc2/sine clips encoded through the normal command builder
+benchmark_folder = os.path.join(output_folder, "benchmark")
+benchmark_resolutions = [(720, 1280), (1080, 1920)]
+benchmark_durations = [5, 20]
+benchmark_modes = [  # (video_codec, prores_encoder, encoder_preset)
+    ("h264", None, "ultrafast"),
+    ("h264", None, "veryfast"),
+    ("hevc", None, "ultrafast"),
+    ("hevc", None, "veryfast"),
+    ("prores_apple", "prores_aw", None),
+    ("prores_apple", "prores_ks", None),
+]
+benchmark_filter_modes = ["all", "none"]  # current switches vs. no pixel/sample filters
+benchmark_mux_modes = ["legacy"]          # widen to e.g. list(MUX_MODE_MOVFLAGS) to compare mux modes
+benchmark_filter_frames = 120             # frames per chain in the --benchmark-filters micro-benchmark
+benchmark_filter_samples = 5              # sampled filter chains per resolution
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v", ".flv"}
+
+# Input discovery: streamed with os.scandir; outputs mirror the input folder tree
+discover_recursive = False
+discover_include = ["*"]       # fnmatch globs on the path relative to input_folder ('/' separators)
+discover_exclude = []          # e.g. ["*/rejected/*", "*_preview.*"]
+discover_min_bytes = 0
+discover_max_bytes = None
+discover_newer_than = None     # unix timestamp: only files modified after it
+discover_older_than = None     # unix timestamp: only files modified before it
+
+# --watch daemon: new files are queued once their size/mtime are stable for watch_stable_seconds.
+# Uses inotify through the optional 'watchdog' package, polling every watch_poll_interval otherwise.
+watch_stable_seconds = 5
+watch_poll_interval = 10
+
+# Multi-node mode (--coordinator / --worker): a shared job queue with leases. Workers must see the
+# inputs under the same paths as the coordinator (shared storage) and run the same settings.
+shared_queue_path = os.path.join(output_folder, "shared_queue.sqlite")
+queue_serve_address = None   # "0.0.0.0:8765" = coordinator also serves the queue over TCP
+queue_token = None           # shared secret required by the TCP queue (recommended off a trusted LAN)
+lease_seconds = 120          # a claimed job returns to the queue if not heartbeated for this long
+heartbeat_interval = 30
+queue_max_attempts = 3       # leases that expire this many times mark the file failed
+queue_poll_interval = 5
+worker_idle_exit = None      # seconds without work before a worker exits; None = keep waiting
+worker_unreachable_exit = 300  # seconds of failed claims (coordinator gone) before a worker exits
+
+# Switches that add filters to the -vf/-af chains
+FILTER_SWITCHES = ("eq", "zoom", "pixel_shift", "speed", "volume", "audio_pitch",
+                   "hue_shift", "simple_noise", "mirror_chance", "crop_variation", "random_resize")
+
+def rv(param, ranges=None, rng=random):
+    ranges = params if ranges is None else ranges
+    return round(rng.uniform(ranges[param][0], ranges[param][1]), 4)
+
+def ri(param, ranges=None, rng=random):
+    ranges = params if ranges is None else ranges
+    return rng.randint(ranges[param][0], ranges[param][1])
+
+def read_first_line(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def read_key_values(path):
+    """'key value' lines (memory.stat, /proc/meminfo) as a dict of ints"""
+    values = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.replace(":", " ").split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    values[parts[0]] = int(parts[1]) * (1024 if parts[-1] == "kB" else 1)
+    except OSError:
+        pass
+    return values
+
+def cgroup_paths():
+    """(cgroup v2 dir or None, {v1 controller: dir}) for this process.
+
+    Inside a container the cgroup namespace usually makes our own group the mount root, so a
+    path from /proc/self/cgroup that doesn't exist falls back to the root of the hierarchy.
+    """
+    v2, v1 = None, {}
+    try:
+        with open("/proc/self/cgroup", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None, {}
+    for line in lines:
+        hierarchy, controllers, path = (line.split(":", 2) + ["", ""])[:3]
+        if hierarchy == "0" and not controllers:
+            candidate = os.path.join("/sys/fs/cgroup", path.lstrip("/"))
+            v2 = candidate if os.path.isdir(candidate) else "/sys/fs/cgroup"
+        for controller in controllers.split(","):
+            if controller:
+                root = os.path.join("/sys/fs/cgroup", controller)
+                candidate = os.path.join(root, path.lstrip("/"))
+                v1[controller] = candidate if os.path.isdir(candidate) else root
+    return v2, v1
+
+@dataclass
+class ResourceLimits:
+    """CPU and memory this process may use: the cgroup's limits, else the host's"""
+    cpus: float
+    memory_bytes: int = None
+    stat_path: str = None     # memory.stat of the cgroup; None = host /proc/meminfo
+    stat_key: str = None      # anonymous memory counter in stat_path (page cache is reclaimable)
+    source: str = "host"
+
+    def memory_used(self):
+        """Non-reclaimable memory in use now (bytes), or None when unknown"""
+        if self.stat_path:
+            return read_key_values(self.stat_path).get(self.stat_key)
+        meminfo = read_key_values("/proc/meminfo")
+        if "MemTotal" in meminfo and "MemAvailable" in meminfo:
+            return meminfo["MemTotal"] - meminfo["MemAvailable"]
+        return None
+
+def detect_resource_limits():
+    """Read cgroup v2 (cpu.max, memory.max) or v1 (cfs quota, memory limit), falling back to the host"""
+    host_cpus = os.cpu_count() or 1
+    limits = ResourceLimits(cpus=host_cpus)
+    v2, v1 = cgroup_paths()
+    if v2 and any(os.path.exists(os.path.join(v2, name)) for name in ("cpu.max", "memory.max")):
+        quota = (read_first_line(os.path.join(v2, "cpu.max")) or "max").split()
+        if quota[0] != "max" and len(quota) == 2:
+            limits.cpus = min(host_cpus, int(quota[0]) / int(quota[1]))
+        memory = read_first_line(os.path.join(v2, "memory.max"))
+        if memory and memory != "max":
+            limits.memory_bytes = int(memory)
+            limits.stat_path, limits.stat_key = os.path.join(v2, "memory.stat"), "anon"
+        limits.source = "cgroup v2"
+    elif v1:
+        cpu_dir = v1.get("cpu") or v1.get("cpuacct")
+        if cpu_dir:
+            quota = read_first_line(os.path.join(cpu_dir, "cpu.cfs_quota_us"))
+            period = read_first_line(os.path.join(cpu_dir, "cpu.cfs_period_us"))
+            if quota and period and int(quota) > 0:
+                limits.cpus = min(host_cpus, int(quota) / int(period))
+        memory_dir = v1.get("memory")
+        memory = read_first_line(os.path.join(memory_dir, "memory.limit_in_bytes")) if memory_dir else None
+        if memory and int(memory) < 1 << 60:  # "unlimited" is reported as a huge page-aligned number
+            limits.memory_bytes = int(memory)
+            limits.stat_path, limits.stat_key = os.path.join(memory_dir, "memory.stat"), "total_rss"
+        limits.source = "cgroup v1"
+    if limits.memory_bytes is None:
+        limits.memory_bytes = read_key_values("/proc/meminfo").get("MemTotal")
+        limits.stat_path = limits.stat_key = None
+    return limits
+
+_resource_limits = None
+
+def resource_limits():
+    global _resource_limits
+    if _resource_limits is None:
+        _resource_limits = detect_resource_limits()
+    return _resource_limits
+
+def available_cpus():
+    """Whole CPUs this process may use (the cgroup quota, not the host's core count)"""
+    return max(1, int(resource_limits().cpus))
+
+def plan_workers(job_count, workers=None):
+    """Return (workers, threads_per_job) so concurrent ffmpeg jobs share all cores"""
+    cpus = available_cpus()
+    if workers is None:
+        workers = max_workers
+    if not workers or workers < 1:
+        workers = max(1, cpus // max(1, threads_per_job_hint))
+    if job_count:
+        workers = min(workers, job_count)
+    workers = max(1, workers)
+    threads = max(1, cpus // workers)
+    return workers, threads
+
+@dataclass
+class ProbeResult:
+    """Parsed single-pass ffprobe output (format + streams)"""
+    duration: float = 0.0
+    size: int = 0
+    format_name: str = ""
+    format_tags: dict = field(default_factory=dict)
+    streams: list = field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, data):
+        fmt = data.get("format", {})
+        try:
+            duration = float(fmt.get("duration", 0) or 0)
+        except ValueError:
+            duration = 0.0
+        return cls(
+            duration=duration,
+            size=int(fmt.get("size", 0) or 0),
+            format_name=fmt.get("format_name", ""),
+            format_tags={k.lower(): v for k, v in fmt.get("tags", {}).items()},
+            streams=data.get("streams", []),
+        )
+
+    def first_stream(self, codec_type):
+        for stream in self.streams:
+            if stream.get("codec_type") == codec_type:
+                return stream
+        return None
+
+    @property
+    def video(self):
+        return self.first_stream("video")
+
+    @property
+    def audio(self):
+        return self.first_stream("audio")
+
+    def stream_tags(self, stream):
+        if not stream:
+            return {}
+        return {k.lower(): v for k, v in stream.get("tags", {}).items()}
 
-def get_video_duration(path):
-    """Get video duration quickly"""
+    @property
+    def codec_tags(self):
+        return [s.get("codec_tag_string") for s in self.streams]
+
+class ProbeCache:
+    """SQLite table of ffprobe output, one row per input path (re-probing a changed file replaces it)"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS probes (
+                input_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                probe_json TEXT
+            )""")
+        self.db.commit()
+
+    def get(self, key):
+        input_path, size, mtime_ns = key
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, probe_json FROM probes WHERE input_path = ?",
+                                  (input_path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        try:
+            return json.loads(row[2])
+        except ValueError:
+            return None
+
+    def put(self, key, data):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO probes (input_path, size, mtime_ns, probe_json) "
+                            "VALUES (?, ?, ?, ?)", (*key, json.dumps(data)))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+_probe_cache = None
+_probe_cache_lock = threading.Lock()
+
+def _probe_cache_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+def probe_cache():
+    """The probe table, opened once per process (None when the database can't be opened)"""
+    global _probe_cache
+    with _probe_cache_lock:
+        if _probe_cache is None:
+            try:
+                _probe_cache = ProbeCache(manifest_path)
+            except sqlite3.Error as e:
+                logging.warning(f"Probe cache unavailable: {e}")
+                _probe_cache = False
+        return _probe_cache or None
+
+def close_probe_cache():
+    """Close the probe table at the end of a batch (rows are committed as they are stored)"""
+    global _probe_cache
+    with _probe_cache_lock:
+        if _probe_cache:
+            _probe_cache.close()
+        _probe_cache = None
+
+def probe_command(path):
+    return ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", path]
+
+def cached_probe(path):
+    """Return (cache_key, ProbeResult or None); the key is None when the file can't be stat'ed"""
+    try:
+        key = _probe_cache_key(path)
+    except OSError:
+        return None, None
+    cache = probe_cache()
     try:
-        cmd = f'ffprobe -v quiet -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{path}"'
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            return float(result.stdout.strip())
-        return 30.0
-    except:
-        return 30.0
+        data = cache.get(key) if cache else None
+    except sqlite3.Error as e:
+        logging.warning(f"Probe cache read failed: {e}")
+        data = None
+    return key, (ProbeResult.from_json(data) if data is not None else None)
+
+def store_probe(key, stdout):
+    """Parse ffprobe JSON output, cache it under key (if given) and return a ProbeResult"""
+    try:
+        data = json.loads(stdout or "{}")
+    except ValueError:
+        return None
+    data = {"format": data.get("format", {}), "streams": data.get("streams", [])}
+    cache = probe_cache() if key is not None else None
+    if cache:
+        try:
+            cache.put(key, data)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not store probe for {os.path.basename(key[0])}: {e}")
+    return ProbeResult.from_json(data)
+
+def probe_video(path, use_cache=True):
+    """Run ffprobe once (JSON output) and return a ProbeResult, or None on failure"""
+    key = None
+    if use_cache:
+        key, cached = cached_probe(path)
+        if key is None:
+            return None
+        if cached is not None:
+            return cached
+    try:
+        result = subprocess.run(probe_command(path), capture_output=True, text=True, timeout=10)
+        if result.returncode != 0:
+            return None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return store_probe(key, result.stdout)
+
+# Preflight: inputs are classified from the probe before any encode is started
+STANDARD_SAMPLE_RATES = {44100, 48000}
+preflight_min_duration = 1.0      # seconds; shorter inputs are rejected
+preflight_truncation_ratio = 0.9  # reject when the file holds less than this share of its indexed bitrate
+PREFLIGHT_VERSION = 2             # bump when the checks change so earlier rejections are re-checked
+
+@dataclass
+class Preflight:
+    """What an input looks like before encoding; ok=False means it must not be queued"""
+    path: str
+    ok: bool = True
+    reason: str = None
+    notes: list = field(default_factory=list)
+    duration: float = 0.0
+    has_audio: bool = False
+    sample_rate: int = None
+    size: tuple = None      # displayed (width, height), i.e. after autorotation
+    rotation: int = 0
+    vfr: bool = False
+
+    def reject(self, reason):
+        self.ok = False
+        self.reason = reason
+        return self
+
+_decodable_codecs = None
+
+def decodable_codecs():
+    """Codec names this ffmpeg can decode, from `ffmpeg -codecs` (empty when that can't be read)"""
+    global _decodable_codecs
+    if _decodable_codecs is None:
+        codecs = set()
+        try:
+            result = subprocess.run(["ffmpeg", "-hide_banner", "-codecs"], capture_output=True, text=True,
+                                    timeout=10)
+            listing = result.stdout.partition("-------")[2]
+            for line in listing.splitlines():
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].startswith("D"):
+                    codecs.add(parts[1])
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        _decodable_codecs = codecs
+    return _decodable_codecs
+
+def parse_rate(value):
+    """'30000/1001' -> 29.97; None for missing or 0/0 rates"""
+    try:
+        num, _, den = str(value).partition("/")
+        rate = float(num) / float(den or 1)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return rate or None
+
+def stream_rotation(probe, stream):
+    """Rotation in degrees from the display matrix side data or the legacy rotate tag"""
+    for side_data in stream.get("side_data_list", []) or []:
+        if "rotation" in side_data:
+            try:
+                return int(round(float(side_data["rotation"]))) % 360
+            except (TypeError, ValueError):
+                pass
+    try:
+        return int(probe.stream_tags(stream).get("rotate", 0)) % 360
+    except (TypeError, ValueError):
+        return 0
+
+def preflight_input(path, probe):
+    """Classify an input from its probe: reject unusable files, note everything the job must adapt to"""
+    check = Preflight(path)
+    if probe is None:
+        return check.reject("unreadable (ffprobe failed)")
+    video = probe.video
+    if video is None:
+        return check.reject("no video stream")
+    codec = video.get("codec_name")
+    if not codec or codec == "none":
+        return check.reject("video stream has no decodable codec")
+    decoders = decodable_codecs()
+    if decoders and codec not in decoders:
+        return check.reject(f"no decoder for video codec {codec}")
+    try:
+        duration = probe.duration or float(video.get("duration", 0) or 0)
+    except ValueError:
+        duration = 0.0
+    if duration < preflight_min_duration:
+        return check.reject(f"duration {duration:.2f}s (empty or truncated)")
+    check.duration = duration
+
+    # Streams whose index promises more data than the file holds were cut off mid-write. Each
+    # stream counts for its own duration; one without a duration only has a nominal header bitrate.
+    indexed_bytes = 0
+    for stream in probe.streams:
+        try:
+            indexed_bytes += int(stream.get("bit_rate", 0) or 0) * float(stream.get("duration", 0) or 0) / 8
+        except ValueError:
+            pass
+    file_size = probe.size or os.path.getsize(path)
+    if indexed_bytes and file_size < preflight_truncation_ratio * indexed_bytes:
+        return check.reject(f"truncated ({file_size // 1024}KB of ~{int(indexed_bytes) // 1024}KB)")
+
+    width, height = int(video.get("width", 0) or 0), int(video.get("height", 0) or 0)
+    if not width or not height:
+        return check.reject("video stream has no dimensions")
+    check.rotation = stream_rotation(probe, video)
+    check.size = (height, width) if check.rotation in (90, 270) else (width, height)
+    if check.rotation:
+        check.notes.append(f"rotated {check.rotation}° (autorotated, {check.size[0]}x{check.size[1]})")
+
+    r_rate, avg_rate = parse_rate(video.get("r_frame_rate")), parse_rate(video.get("avg_frame_rate"))
+    if r_rate and avg_rate and abs(r_rate - avg_rate) > 0.01 * r_rate:
+        check.vfr = True
+        check.notes.append(f"variable frame rate ({avg_rate:.2f} avg vs {r_rate:.2f} fps), output is CFR")
+
+    audio = probe.audio
+    check.has_audio = audio is not None
+    if audio is None:
+        check.notes.append("no audio stream, output is video-only")
+    else:
+        try:
+            check.sample_rate = int(audio.get("sample_rate", 0) or 0) or None
+        except ValueError:
+            check.sample_rate = None
+        if check.sample_rate and check.sample_rate not in STANDARD_SAMPLE_RATES:
+            check.notes.append(f"unusual sample rate {check.sample_rate} Hz")
+    return check
+
+# path -> preflight reason for inputs rejected since the manifest last recorded them
+preflight_rejections = {}
+
+def run_preflight(input_path, probe):
+    """preflight_input plus reporting; rejected inputs are remembered for the manifest"""
+    start = time.time()
+    check = preflight_input(input_path, probe)
+    record_stage("preflight", input_path, time.time() - start, ok=check.ok, reason=check.reason)
+    if not check.ok:
+        print(f"⛔ Rejected in preflight: {check.reason}")
+        logging.warning(f"Preflight rejected {os.path.basename(input_path)}: {check.reason}")
+        preflight_rejections[input_path] = check.reason
+        if preset_controller is not None:
+            preset_controller.skip()
+    for note in check.notes:
+        print(f"   🩺 {note}")
+    return check
 
 def get_advanced_metadata_flags():
     """Generate advanced metadata removal flags"""
@@ -116,25 +697,79 @@ def get_advanced_metadata_flags():
     
     return flags
 
+# Atoms on the path from the file root down to the sample description box (stsd)
+MOV_CONTAINER_ATOMS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+def iter_mov_atoms(f, start, end):
+    """Yield (type, payload_offset, atom_end) for each atom in [start, end) without reading payloads"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            # 64-bit extended size follows the type
+            ext = f.read(8)
+            if len(ext) < 8:
+                return
+            size = struct.unpack(">Q", ext)[0]
+            header_size = 16
+        elif size == 0:
+            # Atom extends to the end of the enclosing range
+            size = end - pos
+        if size < header_size:
+            return  # Corrupt size, stop walking this level
+        yield kind, pos + header_size, min(pos + size, end)
+        pos += size
+
+def find_sample_entry_vendor_offsets(f, file_size):
+    """Return file offsets of the vendor field of every stsd sample entry"""
+    offsets = []
+
+    def walk(start, end):
+        for kind, payload, atom_end in iter_mov_atoms(f, start, end):
+            if kind in MOV_CONTAINER_ATOMS:
+                walk(payload, atom_end)
+            elif kind == b"stsd":
+                f.seek(payload + 4)  # skip version + flags
+                raw = f.read(4)
+                if len(raw) < 4:
+                    continue
+                entry_count = struct.unpack(">I", raw)[0]
+                for index, (_, entry_payload, entry_end) in enumerate(iter_mov_atoms(f, payload + 8, atom_end)):
+                    if index >= entry_count:
+                        break
+                    # Sample entry: reserved(6) data_reference_index(2) version(2) revision(2) vendor(4)
+                    if entry_payload + 16 <= entry_end:
+                        offsets.append(entry_payload + 12)
+
+    walk(0, file_size)
+    return offsets
+
 def patch_mov_vendor(file_path, old=b"FFMP", new=b"appl"):
-    """Best-effort patch: replace first occurrence of old vendor with new in MOV file.
-    This targets the MOV sample entry vendor field exported by ffprobe as tag:vendor_id.
+    """Patch the vendor field of MOV sample entries from old to new, in place.
+
+    Walks the atom tree (moov/trak/mdia/minf/stbl/stsd) with seeks, so memory use is
+    constant and only the 4 vendor bytes of matching sample entries are rewritten.
+    This is the field ffprobe exports as tag:vendor_id.
     """
+    if len(old) != 4 or len(new) != 4:
+        return False
     try:
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        idx = data.find(old)
-        if idx == -1:
-            return False
-        # Replace only the first occurrence to avoid unintended edits
-        patched = data[:idx] + new + data[idx+len(old):]
-        # Write back atomically
-        tmp_path = file_path + ".tmp"
-        with open(tmp_path, 'wb') as f:
-            f.write(patched)
-        os.replace(tmp_path, file_path)
-        return True
-    except Exception:
+        with open(file_path, 'r+b') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            patched = False
+            for offset in find_sample_entry_vendor_offsets(f, file_size):
+                f.seek(offset)
+                if f.read(4) == old:
+                    f.seek(offset)
+                    f.write(new)
+                    patched = True
+            return patched
+    except (OSError, struct.error):
         return False
 
 def get_codec_flags_for_stealth():
@@ -157,336 +792,2675 @@ def get_codec_flags_for_stealth():
         "-tune", "zerolatency",
     ]
 
-def process_video(input_path, output_path):
-    """Enhanced video processing with aggressive metadata removal"""
-    filters_v = []
-    filters_a = []
+def relative_input_dir(input_path):
+    """Directory of input_path relative to input_folder ('' for files outside it)"""
+    rel = os.path.relpath(os.path.dirname(os.path.abspath(input_path)), os.path.abspath(input_folder))
+    if rel == "." or rel.startswith(".."):
+        return ""
+    return rel
 
-    print(f"⚡ Processing: {os.path.basename(input_path)}")
+def make_output_path(input_path, folder=None):
+    """Unique output name for an input file, in the matching subfolder of output_folder"""
+    timestamp = int(time.time() * 1000) % 100000
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    target = os.path.join(folder or output_folder, relative_input_dir(input_path))
+    os.makedirs(target, exist_ok=True)
+    return os.path.join(target, f"ig_{base_name}_{timestamp}.mov")
+
+@dataclass
+class EncodeConfig:
+    """Explicit encode settings, so jobs can be built without touching module globals"""
+    params: dict
+    switches: dict
+    video_codec: str = 'h264'
+    prores_encoder: str = 'prores_ks'
+    prores_profile: str = '3'
+    prores_fourcc: str = 'apch'
+    prores_qscale: str = '9'
+    encoder_preset: str = 'ultrafast'
+    optimize_filters: bool = True
+    mux_mode: str = 'legacy'
+    output_folder: str = ''
+
+    @classmethod
+    def from_globals(cls):
+        return cls(
+            params=dict(params),
+            switches=dict(switches),
+            video_codec=video_codec,
+            prores_encoder=prores_encoder,
+            prores_profile=prores_profile,
+            prores_fourcc=prores_fourcc,
+            prores_qscale=prores_qscale,
+            encoder_preset=encoder_preset,
+            optimize_filters=optimize_filters,
+            mux_mode=output_mux_mode,
+            output_folder=output_folder,
+        )
+
+    def settings(self):
+        """Settings that influence the encoded output (everything but the output folder)"""
+        settings = asdict(self)
+        settings.pop("output_folder")
+        return settings
+
+@dataclass
+class JobSpec:
+    """One output with all random parameters resolved"""
+    input_path: str
+    output_path: str
+    ss: float
+    duration: float
+    filter_v: str
+    filter_a: str  # None when the input has no audio stream
+    framerate: int
+    video_bitrate: int
+    audio_bitrate: int
+    threads: int = 0
+    preset: str = None  # x264/x265 preset override (adaptive controller); None = config.encoder_preset
+    remux_codec: str = None  # set when the video is stream-copied instead of re-encoded
+    copy_audio: bool = False
+    frame_size: tuple = None  # output (width, height) when known
+
+@dataclass
+class FilterOp:
+    """One step of the -vf chain: its ffmpeg text plus the values the optimizer reasons about"""
+    kind: str                 # eq, hue, zoom, crop, shift, noise, resize, format
+    text: str
+    values: dict = field(default_factory=dict)
+
+# Relative cost of one pass of each step per pixel of a 4:2:0 frame (luma + both chroma planes = 1.0).
+# Pixel-moving steps pay for their input and output; a crop only moves plane pointers.
+FILTER_PASS_COST = {
+    "eq": 1.0, "hue": 0.5, "zoom": 2.0, "resize": 1.5, "shift": 1.2,
+    "noise": 2.5, "crop": 0.0, "format": 0.3,
+}
+
+def render_filter_ops(ops):
+    return ",".join(op.text for op in ops) if ops else "format=yuv420p"
+
+def eq_filter_text(values):
+    """eq with only the non-identity parameters (eq skips the chroma planes when saturation is 1)"""
+    parts = [f"{key}={values[key]}" for key in ("brightness", "contrast", "saturation", "gamma")
+             if key in values and values[key] != (0 if key == "brightness" else 1)]
+    return "eq=" + ":".join(parts) if parts else None
+
+def optimize_filter_ops(ops, source_size=None):
+    """Rewrite a filter chain into a cheaper equivalent.
+
+    - identity crops (crop=iw:ih) are dropped;
+    - a uniform zoom followed by an absolute resize only changes the intermediate size, so it is
+      folded into that resize;
+    - eq's saturation moves into hue's s, so eq touches only luma and hue only chroma;
+    - when the final resize shrinks the frame, it runs first so every per-pixel step sees fewer
+      pixels (the small pad/shift offsets are kept in pixels, at the new size).
+    """
+    ops = [op for op in ops if not (op.kind == "crop" and op.values.get("identity"))]
+    resize_at = next((i for i, op in enumerate(ops) if op.kind == "resize"), None)
+    if resize_at is not None:
+        ops = [op for i, op in enumerate(ops) if not (op.kind == "zoom" and i < resize_at)]
+
+    eq = next((op for op in ops if op.kind == "eq"), None)
+    hue = next((op for op in ops if op.kind == "hue"), None)
+    if eq is not None and hue is not None and eq.values.get("saturation", 1) != 1:
+        eq_values = dict(eq.values, saturation=1)
+        hue_values = dict(hue.values, s=round(hue.values.get("s", 1) * eq.values["saturation"], 4))
+        eq_text = eq_filter_text(eq_values)
+        merged = []
+        for op in ops:
+            if op is eq:
+                if eq_text:
+                    merged.append(FilterOp("eq", eq_text, eq_values))
+            elif op is hue:
+                merged.append(FilterOp("hue", f"hue=h={hue_values['h']}:s={hue_values['s']}", hue_values))
+            else:
+                merged.append(op)
+        ops = merged
+
+    resize = next((op for op in ops if op.kind == "resize"), None)
+    if resize is not None and source_size and ops[0] is not resize:
+        current = frame_size_before(ops, ops.index(resize), source_size)
+        if resize.values["width"] * resize.values["height"] < current[0] * current[1]:
+            ops = [resize] + [op for op in ops if op is not resize]
+    return ops
+
+def frame_size_before(ops, index, source_size):
+    """Frame size entering ops[index] (only zoom and resize change it)"""
+    width, height = source_size
+    for op in ops[:index]:
+        if op.kind == "zoom":
+            factor = op.values["factor"]
+            width, height = int(width * factor) // 2 * 2, int(height * factor) // 2 * 2
+        elif op.kind == "resize":
+            width, height = op.values["width"], op.values["height"]
+    return width, height
+
+def filter_chain_cost(ops, source_size):
+    """Modelled per-frame cost of a chain, in megapixel-passes"""
+    cost = 0.0
+    for i, op in enumerate(ops):
+        width, height = frame_size_before(ops, i, source_size)
+        pixels = width * height
+        if op.kind in ("zoom", "resize"):
+            out_w, out_h = frame_size_before(ops, i + 1, source_size)
+            pixels = max(pixels, out_w * out_h)
+        weight = FILTER_PASS_COST.get(op.kind, 1.0)
+        if op.kind == "eq" and op.values.get("saturation", 1) == 1:
+            weight *= 2 / 3  # luma plane only
+        cost += weight * pixels / 1e6
+    return cost
 
-    # Get video duration
-    video_duration = get_video_duration(input_path)
+def resolve_job(config, input_path, output_path, video_duration, threads=0, rng=random, preset=None,
+                source_size=None, check=None):
+    """Sample the random parameters for one output and return its JobSpec.
+
+    With a Preflight the audio chain follows the real stream layout (sample rate, or no audio).
+    """
+    p, sw = config.params, config.switches
+    has_audio = check.has_audio if check is not None else True
+    sample_rate = (check.sample_rate if check is not None else None) or 44100
+    if source_size is None and check is not None:
+        source_size = check.size
+    filters_v = []
+    filters_a = []
 
     # Color changes
-    if switches["eq"]:
-        brightness = rv('brightness')
-        contrast = rv('contrast')
-        saturation = rv('saturation')
-        gamma = rv('gamma')
-        filters_v.append(f"eq=brightness={brightness}:contrast={contrast}:saturation={saturation}:gamma={gamma}")
+    if sw["eq"]:
+        brightness = rv('brightness', p, rng)
+        contrast = rv('contrast', p, rng)
+        saturation = rv('saturation', p, rng)
+        gamma = rv('gamma', p, rng)
+        filters_v.append(FilterOp(
+            "eq", f"eq=brightness={brightness}:contrast={contrast}:saturation={saturation}:gamma={gamma}",
+            {"brightness": brightness, "contrast": contrast, "saturation": saturation, "gamma": gamma}))
         print(f"   🎨 Color: b={brightness:.3f} c={contrast:.3f} s={saturation:.3f} g={gamma:.3f}")
 
     # Hue shift
-    if switches["hue_shift"] and random.random() < 0.8:
-        hue_degrees = ri("hue_shift")
+    if sw["hue_shift"] and rng.random() < 0.8:
+        hue_degrees = ri("hue_shift", p, rng)
         if abs(hue_degrees) > 3:
-            filters_v.append(f"hue=h={hue_degrees}")
+            filters_v.append(FilterOp("hue", f"hue=h={hue_degrees}", {"h": hue_degrees}))
             print(f"   🌈 Hue shift: {hue_degrees}°")
 
     # Zoom
-    if switches["zoom"] and random.random() < 0.6:
-        zoom_factor = rv("zoom")
+    if sw["zoom"] and rng.random() < 0.6:
+        zoom_factor = rv("zoom", p, rng)
         if zoom_factor > 1.005:
-            filters_v.append(f"scale=iw*{zoom_factor}:ih*{zoom_factor}:force_original_aspect_ratio=decrease:force_divisible_by=2,crop=iw:ih")
+            filters_v.append(FilterOp(
+                "zoom",
+                f"scale=iw*{zoom_factor}:ih*{zoom_factor}:force_original_aspect_ratio=decrease:force_divisible_by=2",
+                {"factor": zoom_factor}))
+            filters_v.append(FilterOp("crop", "crop=iw:ih", {"identity": True}))
             print(f"   🔍 Zoom: {zoom_factor:.3f}x")
 
     # Pixel shift
-    if switches["pixel_shift"] and random.random() < 0.7:
-        shift_x, shift_y = ri("pixel_shift_x"), ri("pixel_shift_y")
+    if sw["pixel_shift"] and rng.random() < 0.7:
+        shift_x, shift_y = ri("pixel_shift_x", p, rng), ri("pixel_shift_y", p, rng)
         if abs(shift_x) > 0 or abs(shift_y) > 0:
-            filters_v.append(f"pad=iw+4:ih+4:2:2,crop=iw-4:ih-4:{shift_x+2}:{shift_y+2}")
+            filters_v.append(FilterOp("shift", f"pad=iw+4:ih+4:2:2,crop=iw-4:ih-4:{shift_x+2}:{shift_y+2}",
+                                      {"x": shift_x, "y": shift_y}))
             print(f"   📐 Pixel shift: x={shift_x}, y={shift_y}")
 
     # Simple noise
-    if switches["simple_noise"] and random.random() < 0.5:
-        noise_strength = random.randint(2, 5)
-        filters_v.append(f"noise=alls={noise_strength}:allf=t")
+    if sw["simple_noise"] and rng.random() < 0.5:
+        noise_strength = rng.randint(2, 5)
+        filters_v.append(FilterOp("noise", f"noise=alls={noise_strength}:allf=t", {"strength": noise_strength}))
         print(f"   📺 Noise: strength={noise_strength}")
 
     # Force re-encoding for metadata removal (always apply slight filter)
-    if switches["force_reencoding"] and not filters_v:
+    if sw["force_reencoding"] and not sw.get("remux_fast_path", False) and not filters_v:
         # Apply minimal filter to force re-encoding
-        filters_v.append("format=yuv420p")
+        filters_v.append(FilterOp("format", "format=yuv420p"))
         print("   🔄 Forced re-encoding for metadata removal")
 
     # Audio pitch
-    if switches["audio_pitch"] and random.random() < 0.8:
-        pitch_factor = round(random.uniform(0.998, 1.004), 4)
-        if abs(pitch_factor - 1.0) > 0.001:
-            filters_a.append(f"asetrate=44100*{pitch_factor},aresample=44100")
+    if sw["audio_pitch"] and rng.random() < 0.8:
+        pitch_factor = round(rng.uniform(0.998, 1.004), 4)
+        if has_audio and abs(pitch_factor - 1.0) > 0.001:
+            filters_a.append(f"asetrate={sample_rate}*{pitch_factor},aresample={sample_rate}")
             print(f"   🎵 Audio pitch: {pitch_factor:.4f}x")
 
     # Volume changes
-    if switches["volume"]:
-        vol_change = rv("volume")
-        if abs(vol_change - 1.0) > 0.02:
+    if sw["volume"]:
+        vol_change = rv("volume", p, rng)
+        if has_audio and abs(vol_change - 1.0) > 0.02:
             filters_a.append(f"volume={vol_change}")
             print(f"   🔊 Volume: {vol_change:.3f}x")
 
     # Fixed 9:16 resize
-    if switches["random_resize"]:
-        w = random.choice([1080, 1200, 1350, 1440, 1620, 1800])
+    if sw["random_resize"]:
+        w = rng.choice([1080, 1200, 1350, 1440, 1620, 1800])
         h = int(w * 16 / 9)
         if w % 2 != 0: w += 1
         if h % 2 != 0: h += 1
-        filters_v.append(f"scale={w}:{h}:flags=fast_bilinear")
+        filters_v.append(FilterOp("resize", f"scale={w}:{h}:flags=fast_bilinear", {"width": w, "height": h}))
         print(f"   📱 Resize: {w}x{h} (9:16)")
 
-    # Combine filters
-    filter_v = ",".join(filters_v) if filters_v else "format=yuv420p"  # Always apply at least format filter
-    filter_a = ",".join(filters_a) if filters_a else "aformat=sample_fmts=fltp"  # Always apply audio format filter
+    # Combine filters (always at least the format filter)
+    if config.optimize_filters and filters_v:
+        optimized = optimize_filter_ops(filters_v, source_size)
+        if source_size:
+            before, after = filter_chain_cost(filters_v, source_size), filter_chain_cost(optimized, source_size)
+            if after < before:
+                print(f"   🧮 Filter graph: {before:.1f} → {after:.1f} Mpx-passes/frame")
+        filters_v = optimized
+    filter_v = render_filter_ops(filters_v)
+    resize = next((op for op in filters_v if op.kind == "resize"), None)
+    frame_size = (resize.values["width"], resize.values["height"]) if resize else source_size
+    filter_a = None  # no audio stream: the job is encoded with -an
+    if has_audio:
+        filter_a = ",".join(filters_a) if filters_a else "aformat=sample_fmts=fltp"  # Always apply audio format filter
 
     # Trimming
-    ss = rv("cut_start")
-    cut_end = rv("cut_end")
+    ss = rv("cut_start", p, rng)
+    cut_end = rv("cut_end", p, rng)
     duration = max(video_duration - ss - cut_end, 3.0)
     print(f"   ✂️ Trim: start={ss:.1f}s, end={cut_end:.1f}s, duration={duration:.1f}s")
 
-    # Generate output path
-    timestamp = int(time.time() * 1000) % 100000
-    base_name = os.path.splitext(os.path.basename(input_path))[0]
-    unique_output = os.path.join(output_folder, f"ig_{base_name}_{timestamp}.mov")
+    return JobSpec(
+        input_path=input_path,
+        output_path=output_path,
+        ss=ss,
+        duration=duration,
+        filter_v=filter_v,
+        filter_a=filter_a,
+        framerate=ri("framerate", p, rng),
+        video_bitrate=ri("video_bitrate", p, rng),
+        audio_bitrate=ri("audio_bitrate", p, rng),
+        threads=threads,
+        preset=preset,
+        frame_size=frame_size,
+    )
 
-    # Build FFmpeg command with enhanced metadata removal
-    command = [
-        "ffmpeg",
-        "-hide_banner",
-        "-loglevel", "error",
-        "-ss", str(ss),
-        "-i", input_path,
-        "-t", str(duration),
-        "-vf", filter_v,
-        "-af", filter_a,
-    ]
+def estimate_moov_size(job):
+    """Bytes to reserve for moov so it fits in front of mdat without a rewrite.
 
-    # Video encoding flags based on codec
-    if video_codec == 'prores_apple':
-        # Apple ProRes with Apple vendor code (apl0). Larger files, but vendor can be set.
-        if prores_encoder == 'prores_aw':
-            command.extend([
-                "-c:v", "prores_aw",
-                "-pix_fmt", "yuv422p10le",
-                "-r", str(ri("framerate")),
-                "-vendor", "appl",            # Apple vendor code
-                "-tag:v", prores_fourcc,       # FourCC e.g. apcn/apch
-                "-qscale:v", prores_qscale,
-            ])
-        else:
-            command.extend([
-                "-c:v", "prores_ks",
-                "-profile:v", prores_profile,  # ProRes profile index
-                "-pix_fmt", "yuv422p10le",
-                "-r", str(ri("framerate")),
-                "-vendor", "appl",            # Apple vendor code
-                "-tag:v", prores_fourcc,       # FourCC e.g. apcn/apch
-                "-qscale:v", prores_qscale,    # Quality scale (lower is higher quality)
-            ])
-        # As a fallback for tools reading tags, also set stream metadata
-        command.extend([
-            "-metadata:s:v:0", "vendor_id=appl",
-        ])
-    elif video_codec == 'hevc':
-        # iPhone-like HEVC
-        command.extend([
-            "-c:v", "libx265",
-            "-pix_fmt", "yuv420p",
-            "-b:v", f"{ri('video_bitrate')}k",
-            "-r", str(ri("framerate")),
-            "-tag:v", "hvc1",
-            "-preset", "ultrafast",
-            "-x265-params", "no-info=1",
-        ])
-    else:
+    About 20 bytes of sample tables per video frame and 12 per AAC frame (1024 samples), doubled:
+    ffmpeg fails the mux when the reservation turns out too small.
+    """
+    video_frames = job.duration * job.framerate
+    audio_frames = job.duration * 48000 / 1024 if job.filter_a or job.copy_audio else 0
+    size = 2 * (8192 + 20 * video_frames + 12 * audio_frames)
+    return int(-(-size // 4096) * 4096)
+
+class CommandBuilder:
+    """Builds ffmpeg argv for JobSpecs; flag blocks that only depend on the config are built once"""
+
+    def __init__(self, config):
+        self.config = config
+        self.video_flags = self._video_codec_flags()
+        self.audio_flags = ["-c:a", "aac", "-profile:a", "aac_low"]
+        self.container_flags = self._container_flags()
+        self.metadata_flags = self._metadata_flags()
+
+    def _video_codec_flags(self):
+        c = self.config
+        if c.video_codec == 'prores_apple':
+            # Apple ProRes with Apple vendor code (apl0). Larger files, but vendor can be set.
+            if c.prores_encoder == 'prores_aw':
+                flags = [
+                    "-c:v", "prores_aw",
+                    "-pix_fmt", "yuv422p10le",
+                    "-vendor", "appl",            # Apple vendor code
+                    "-tag:v", c.prores_fourcc,     # FourCC e.g. apcn/apch
+                    "-qscale:v", c.prores_qscale,
+                ]
+            else:
+                flags = [
+                    "-c:v", "prores_ks",
+                    "-profile:v", c.prores_profile,  # ProRes profile index
+                    "-pix_fmt", "yuv422p10le",
+                    "-vendor", "appl",            # Apple vendor code
+                    "-tag:v", c.prores_fourcc,     # FourCC e.g. apcn/apch
+                    "-qscale:v", c.prores_qscale,  # Quality scale (lower is higher quality)
+                ]
+            # As a fallback for tools reading tags, also set stream metadata
+            flags.extend(["-metadata:s:v:0", "vendor_id=appl"])
+            return flags
+        if c.video_codec == 'hevc':
+            # iPhone-like HEVC
+            return [
+                "-c:v", "libx265",
+                "-pix_fmt", "yuv420p",
+                "-tag:v", "hvc1",
+                "-x265-params", "no-info=1",
+            ]
         # Default H.264
-        command.extend([
+        return [
             "-c:v", "libx264",
             "-profile:v", "baseline",
             "-level:v", "3.1",
             "-pix_fmt", "yuv420p",
-            "-b:v", f"{ri('video_bitrate')}k",
-            "-r", str(ri("framerate")),
             "-tag:v", "avc1",
-            "-preset", "ultrafast",
             "-crf", "24",
             "-tune", "zerolatency",
             "-x264-params", "info=0:nal-hrd=none:filler=0:aud=0:annexb=0",
-        ])
+        ]
 
-    # Audio encoding
-    if video_codec == 'prores_apple':
-        # AAC is fine for size; PCM also acceptable but much larger. Keep AAC.
-        command.extend([
-            "-c:a", "aac",
-            "-b:a", f"{ri('audio_bitrate')}k",
-            "-profile:a", "aac_low",
+    def _container_flags(self):
+        if self.config.mux_mode not in MUX_MODE_MOVFLAGS:
+            raise ValueError(f"unknown mux mode {self.config.mux_mode!r}")
+        movflags = MUX_MODE_MOVFLAGS[self.config.mux_mode]
+        return ([] if movflags is None else ["-movflags", movflags]) + [
+            "-write_tmcd", "0",
+            "-max_muxing_queue_size", "1024",
+            "-fflags", "+genpts+bitexact",
+            "-flags:v", "+bitexact",
+            "-flags:a", "+bitexact",
+            "-avoid_negative_ts", "make_zero",
+            # Set MOV major brand to QuickTime explicitly
+            "-brand", "qt",
+        ]
+
+    def _metadata_flags(self):
+        # Add aggressive metadata removal flags
+        if self.config.switches["aggressive_metadata_removal"]:
+            flags = get_advanced_metadata_flags()
+        else:
+            flags = ["-map_metadata", "-1"]
+        # Explicitly clear encoder tags on container and streams
+        flags.extend([
+            "-metadata", "encoder=",
+            "-metadata:s:v:0", "encoder=",
+            "-metadata:s:a:0", "encoder=",
         ])
-    else:
-        command.extend([
-            "-c:a", "aac",
-            "-b:a", f"{ri('audio_bitrate')}k",
-            "-profile:a", "aac_low",
+        # Set iPhone-like stream handler names (these are just labels)
+        flags.extend([
+            "-metadata:s:v:0", "handler_name=Core Media Video",
+            "-metadata:s:a:0", "handler_name=Core Media Audio",
         ])
+        return flags
 
-    # Container and processing flags
-    command.extend([
-        "-movflags", "+faststart+empty_moov",
-        "-write_tmcd", "0",
-        "-max_muxing_queue_size", "1024",
-        "-fflags", "+genpts+bitexact",
-        "-flags:v", "+bitexact",
-        "-flags:a", "+bitexact",
-        "-avoid_negative_ts", "make_zero",
-        "-threads", "0",
-        # Set MOV major brand to QuickTime explicitly
-        "-brand", "qt",
-    ])
-    
-    # Add aggressive metadata removal flags
-    if switches["aggressive_metadata_removal"]:
-        command.extend(get_advanced_metadata_flags())
-        print("   🛡️ Aggressive metadata removal enabled")
-    else:
-        command.extend(["-map_metadata", "-1"])
-    
-    # Explicitly clear encoder tags on container and streams
-    command.extend([
-        "-metadata", "encoder=",
-        "-metadata:s:v:0", "encoder=",
-        "-metadata:s:a:0", "encoder=",
-    ])
-
-    # Set iPhone-like stream handler names (these are just labels)
-    command.extend([
-        "-metadata:s:v:0", "handler_name=Core Media Video",
-        "-metadata:s:a:0", "handler_name=Core Media Audio",
-    ])
-    
-    # Add output file and overwrite flag
-    command.extend(["-y", unique_output])
+    def job_video_flags(self, job):
+        """Per-job rate/bitrate flags that go with the cached codec block"""
+        if self.config.video_codec == 'prores_apple':
+            return ["-r", str(job.framerate)]
+        return ["-preset", job.preset or self.config.encoder_preset,
+                "-b:v", f"{job.video_bitrate}k", "-r", str(job.framerate)]
+
+    def job_container_flags(self, job):
+        """Container flags plus the per-job moov reservation in 'reserved' mode"""
+        if self.config.mux_mode == "reserved":
+            return self.container_flags + ["-moov_size", str(estimate_moov_size(job))]
+        return self.container_flags
+
+    def job_audio_flags(self, job):
+        if not job.filter_a:
+            return []
+        return self.audio_flags + ["-b:a", f"{job.audio_bitrate}k"]
+
+    def build(self, job):
+        """Full ffmpeg argv for a JobSpec"""
+        if job.remux_codec:
+            return self.build_remux(job)
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-ss", str(job.ss),
+            "-i", job.input_path,
+            "-t", str(job.duration),
+            "-vf", job.filter_v,
+        ]
+        command.extend(["-af", job.filter_a] if job.filter_a else ["-an"])
+        command.extend(self.video_flags)
+        command.extend(self.job_video_flags(job))
+        command.extend(self.job_audio_flags(job))
+        command.extend(self.job_container_flags(job))
+        command.extend(["-threads", str(job.threads)])
+        command.extend(self.metadata_flags)
+        # Add output file and overwrite flag
+        command.extend(["-y", job.output_path])
+        return command
+
+    def build_remux(self, job):
+        """Stream-copy argv: trim, drop SEI via bitstream filter and clear metadata, no decode"""
+        tag, bsf = REMUX_BITSTREAM_FILTERS[job.remux_codec]
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-ss", str(job.ss),
+            "-i", job.input_path,
+            "-t", str(job.duration),
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c:v", "copy",
+            "-tag:v", tag,
+            "-bsf:v", bsf,
+        ]
+        if job.copy_audio:
+            command.extend(["-c:a", "copy"])
+        else:
+            command.extend(self.job_audio_flags(job))
+        command.extend(self.job_container_flags(job))
+        command.extend(self.metadata_flags)
+        command.extend(["-y", job.output_path])
+        return command
+
+    def build_segment(self, job, start, length, path, threads):
+        """Video-only argv for one segment [start, start + length) of a job"""
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-ss", str(start),
+            "-i", job.input_path,
+            "-t", str(length),
+            "-vf", job.filter_v,
+            "-an",
+        ]
+        command.extend(self.video_flags)
+        command.extend(self.job_video_flags(job))
+        command.extend(["-fflags", "+bitexact", "-flags:v", "+bitexact", "-threads", str(threads),
+                        "-map_metadata", "-1", "-y", path])
+        return command
+
+    def build_audio_only(self, job, path):
+        """Audio-only argv covering the whole trimmed range of a job"""
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-ss", str(job.ss),
+            "-i", job.input_path,
+            "-t", str(job.duration),
+            "-vn",
+            "-af", job.filter_a,
+        ]
+        command.extend(self.audio_flags)
+        command.extend(["-b:a", f"{job.audio_bitrate}k", "-flags:a", "+bitexact", "-map_metadata", "-1",
+                        "-y", path])
+        return command
+
+    def build_concat(self, job, list_path, audio_path=None):
+        """Stream-copy the encoded segments (concat demuxer) and the audio, if any, into the final output"""
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+        ]
+        if audio_path:
+            command.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"])
+        else:
+            command.extend(["-map", "0:v:0"])
+        command.extend(["-c", "copy"])
+        if self.config.video_codec == 'prores_apple':
+            command.extend(["-vendor", "appl", "-metadata:s:v:0", "vendor_id=appl"])
+        command.extend(self.job_container_flags(job))
+        command.extend(self.metadata_flags)
+        command.extend(["-y", job.output_path])
+        return command
+
+    def output_flags(self, job):
+        """Encoder, container and metadata flags for one output of a multi-output command"""
+        flags = list(self.video_flags)
+        flags.extend(self.job_video_flags(job))
+        flags.extend(self.job_audio_flags(job))
+        flags.extend(self.job_container_flags(job))
+        flags.extend(["-threads", str(job.threads)])  # an output option: every output needs its own
+        flags.extend(self.metadata_flags)
+        return flags
+
+    def build_multi(self, jobs):
+        """One ffmpeg argv that decodes the input once and writes every job as its own output.
+
+        The decoded streams are fanned out with split/asplit; each branch gets its job's
+        filter chain and encoder settings. The seek point of the first job is shared.
+        """
+        count = len(jobs)
+        has_audio = bool(jobs[0].filter_a)
+        graph = ["[0:v]split=" + str(count) + "".join(f"[vin{i}]" for i in range(count))]
+        if has_audio:
+            graph.append("[0:a]asplit=" + str(count) + "".join(f"[ain{i}]" for i in range(count)))
+        for i, job in enumerate(jobs):
+            graph.append(f"[vin{i}]{job.filter_v}[vout{i}]")
+            if has_audio:
+                graph.append(f"[ain{i}]{job.filter_a}[aout{i}]")
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-ss", str(jobs[0].ss),
+            "-i", jobs[0].input_path,
+            "-filter_complex", ";".join(graph),
+        ]
+        for i, job in enumerate(jobs):
+            command.extend(["-map", f"[vout{i}]"])
+            if has_audio:
+                command.extend(["-map", f"[aout{i}]"])
+            command.extend(["-t", str(job.duration)])
+            command.extend(self.output_flags(job))
+            command.extend(["-y", job.output_path])
+        return command
+
+_builder_cache = {}
+_builder_cache_lock = threading.Lock()
+
+def get_command_builder(config):
+    """CommandBuilder for a config, cached by settings fingerprint"""
+    key = settings_fingerprint(config.settings())
+    with _builder_cache_lock:
+        builder = _builder_cache.get(key)
+        if builder is None:
+            builder = _builder_cache[key] = CommandBuilder(config)
+        return builder
+
+@dataclass
+class FFmpegRun:
+    """Outcome of one ffmpeg process"""
+    returncode: int
+    stderr: str
+    elapsed: float
+    peak_rss_kb: int = None  # ru_maxrss of the process (KB on Linux), None where unavailable
+    progress: dict = None    # last -progress block (fps, speed, out_time_us, ...)
+    # Block I/O of the process from ru_inblock/ru_oublock (512-byte units). Page-cache hits
+    # are not reads, and network filesystems may not be counted at all.
+    read_bytes: int = None
+    write_bytes: int = None
+
+class FFmpegStalled(subprocess.TimeoutExpired):
+    """ffmpeg stopped reporting progress for longer than the stall timeout"""
+
+def parse_progress_value(key, value):
+    """Convert one -progress key=value pair into a number where it is numeric"""
+    value = value.strip()
+    if key in ("frame", "out_time_us", "out_time_ms", "total_size"):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    if key in ("fps", "speed"):
+        try:
+            return float(value.rstrip("x"))
+        except ValueError:
+            return None
+    return value
+
+class ProgressTracker:
+    """Accumulates ffmpeg -progress key=value lines into blocks and tracks when output last advanced"""
+
+    def __init__(self, on_progress=None, duration=None):
+        self.on_progress = on_progress
+        self.duration = duration  # expected output length in seconds, if known
+        self.last_advance = time.time()
+        self.last = None
+        self._block = {}
+        self._marker = None
+
+    def feed(self, line):
+        key, sep, value = line.partition("=")
+        if not sep:
+            return
+        key = key.strip()
+        self._block[key] = parse_progress_value(key, value)
+        if key != "progress":
+            return
+        block, self._block = self._block, {}
+        marker = (block.get("frame"), block.get("out_time_us", block.get("out_time_ms")))
+        if marker != self._marker:
+            self._marker = marker
+            self.last_advance = time.time()
+        self.last = block
+        if self.on_progress is not None:
+            self.on_progress(block)
+
+    @property
+    def output_complete(self):
+        """True once every frame is out; the muxer may still be finishing (e.g. the faststart rewrite)"""
+        if self.duration is None or self.last is None:
+            return False
+        out_time_us = self.last.get("out_time_us", self.last.get("out_time_ms"))
+        return out_time_us is not None and out_time_us >= (self.duration - 0.5) * 1_000_000
+
+def with_progress(command):
+    """Insert -progress pipe:1 -nostats after the program name"""
+    if "-progress" in command:
+        return command
+    return command[:1] + ["-progress", "pipe:1", "-nostats"] + command[1:]
 
-    # Execute command
+def run_ffmpeg(command, timeout=None, stall_timeout=None, on_progress=None, duration=None):
+    """Run an ffmpeg/ffprobe argv, collecting its own peak RSS via wait4 where supported.
+
+    With stall_timeout or on_progress, ffmpeg is started with -progress pipe:1 and its
+    progress blocks are streamed; the process is killed (FFmpegStalled) when neither frame
+    nor out_time advance for stall_timeout seconds. Once out_time reaches duration (the
+    expected output length) the stall timeout no longer applies, so a muxer pass after the
+    last frame (faststart moving moov) isn't mistaken for a stall. timeout is an optional hard limit.
+    """
+    watch_progress = stall_timeout is not None or on_progress is not None
+    if watch_progress:
+        command = with_progress(command)
     start_time = time.time()
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE if watch_progress else subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    stderr_parts = []
+    readers = [threading.Thread(target=lambda: stderr_parts.append(proc.stderr.read()), daemon=True)]
+    tracker = ProgressTracker(on_progress, duration)
+
+    def read_progress():
+        for line in proc.stdout:
+            tracker.feed(line)
+
+    if watch_progress:
+        readers.append(threading.Thread(target=read_progress, daemon=True))
+    for reader in readers:
+        reader.start()
+
+    def stop(exc):
+        proc.kill()
+        proc.wait()
+        for reader in readers:
+            reader.join(timeout=5)
+        raise exc
+
+    peak_rss_kb = read_bytes = write_bytes = None
+    while True:
+        if hasattr(os, "wait4"):
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                peak_rss_kb = usage.ru_maxrss
+                read_bytes, write_bytes = usage.ru_inblock * 512, usage.ru_oublock * 512
+                break
+        elif proc.poll() is not None:
+            break
+        now = time.time()
+        if timeout is not None and now - start_time > timeout:
+            stop(subprocess.TimeoutExpired(command, timeout))
+        if (stall_timeout is not None and now - tracker.last_advance > stall_timeout
+                and not tracker.output_complete):
+            stop(FFmpegStalled(command, stall_timeout))
+        time.sleep(0.05)
+    for reader in readers:
+        reader.join(timeout=5)
+    proc.stderr.close()
+    if proc.stdout is not None:
+        proc.stdout.close()
+    return FFmpegRun(proc.returncode, "".join(stderr_parts), time.time() - start_time,
+                     peak_rss_kb, tracker.last, read_bytes, write_bytes)
+
+_stage_totals = {}
+_stage_lock = threading.Lock()
+
+def record_stage(stage, input_path, seconds, **extra):
+    """Append a structured per-stage timing record (probe, encode, patch, verify)"""
+    record = {"ts": round(time.time(), 3), "file": os.path.basename(input_path),
+              "stage": stage, "seconds": round(seconds, 4)}
+    record.update(extra)
+    with _stage_lock:
+        _stage_totals[stage] = _stage_totals.get(stage, 0.0) + seconds
+        try:
+            with open(stage_log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logging.warning(f"Could not write stage record: {e}")
+
+@contextmanager
+def timed_stage(stage, input_path):
+    """Context manager that records how long the wrapped stage took"""
+    start = time.time()
     try:
-        result = subprocess.run(command, capture_output=True, text=True, timeout=180)
-        process_time = time.time() - start_time
-        if result.returncode != 0:
-            print(f"❌ Error: {result.stderr[-200:]}")
-            logging.error(f"FFmpeg error for {os.path.basename(input_path)}: {result.stderr}")
-            return False, process_time
-        if os.path.exists(unique_output):
-            output_size = os.path.getsize(unique_output)
-            input_size = os.path.getsize(input_path)
-            size_ratio = output_size / input_size
-            print(f"✅ Success in {process_time:.1f}s: {os.path.basename(unique_output)}")
-            print(f"   📊 Size: {input_size//1024}KB → {output_size//1024}KB ({size_ratio:.2f}x)")
-            
-            # Optional: Patch vendor and verify metadata removal
-            if switches.get("force_vendor_patch", False):
-                if patch_mov_vendor(unique_output):
-                    print("   🔧 Patched MOV vendor_id: FFMP → appl")
-                else:
-                    print("   🔧 Vendor patch skipped (marker not found)")
-            if switches["aggressive_metadata_removal"]:
-                details = verify_metadata_removal(unique_output)
-                # Print a compact one-liner of key details if available
-                if details:
-                    brand = details.get("major_brand")
-                    vtag = details.get("vendor_id_tag")
-                    vctag = details.get("v_codec_tag_string")
-                    vhdl = details.get("v_handler")
-                    ahdl = details.get("a_handler")
-                    summary_parts = []
-                    if brand:
-                        summary_parts.append(f"brand={brand}")
-                    if vctag:
-                        summary_parts.append(f"codec_tag={vctag}")
-                    if vtag:
-                        summary_parts.append(f"tag:vendor_id={vtag}")
-                    if vhdl:
-                        summary_parts.append(f"v_handler={vhdl}")
-                    if ahdl:
-                        summary_parts.append(f"a_handler={ahdl}")
-                    if summary_parts:
-                        print("   🧾 Details: " + ", ".join(summary_parts))
-            
-            return True, process_time
+        yield
+    finally:
+        record_stage(stage, input_path, time.time() - start)
+
+# Input name of the job the current thread/task is reporting for (prefix for concurrent output)
+_job_label = contextvars.ContextVar("job_label", default=None)
+
+class JobOutput:
+    """sys.stdout for concurrent jobs: writes whole lines only, each prefixed with its job's input name"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.pending = threading.local()
+
+    def write(self, text):
+        *lines, rest = (getattr(self.pending, "text", "") + text).split("\n")
+        self.pending.text = rest
+        if lines:
+            label = _job_label.get()
+            prefix = f"[{label}] " if label else ""
+            with self.lock:
+                self.stream.write("".join(f"{prefix}{line}\n" if line else "\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def use_job_output():
+    """Route stdout through JobOutput so concurrent jobs don't interleave within lines"""
+    if not isinstance(sys.stdout, JobOutput):
+        sys.stdout = JobOutput(sys.stdout)
+
+@contextmanager
+def job_output(input_path):
+    """Label everything printed in the block (and in threads/tasks started from it) with the input name"""
+    token = _job_label.set(os.path.basename(input_path))
+    try:
+        yield
+    finally:
+        _job_label.reset(token)
+
+def model_output_io(config, job, input_size, output_size):
+    """Modelled (read, written) bytes for one output: the mux passes plus the post-mux checks.
+
+    The input is read once. The mux writes the output once, and faststart moves moov to the front
+    by reading and rewriting the finished file. The vendor patch only reads atom headers. Verify
+    scans the first banner_scan_bytes for encoder strings.
+    """
+    extra_reads, writes = MUX_MODE_PASSES.get(config.mux_mode, (0, 1))
+    read = input_size + extra_reads * output_size
+    if config.switches.get("aggressive_metadata_removal"):
+        read += min(output_size, banner_scan_bytes)
+    return read, writes * output_size
+
+class BatchMetrics:
+    """Per-job JSON-lines records plus Prometheus textfile-collector counters and histograms"""
+
+    # Histogram upper bounds (le) per observed value
+    BUCKETS = {
+        "encode_seconds": (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800),
+        "realtime_factor": (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+        "size_ratio": (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 4),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.jobs = {}      # (status, codec) -> count
+            self.totals = {"input_bytes": 0, "output_bytes": 0, "encode_seconds": 0.0, "media_seconds": 0.0,
+                           "io_read_bytes": 0, "io_write_bytes": 0,
+                           "io_model_read_bytes": 0, "io_model_write_bytes": 0}
+            self.histograms = {name: {"buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+                               for name, bounds in self.BUCKETS.items()}
+
+    def _observe(self, name, value):
+        hist = self.histograms[name]
+        for i, bound in enumerate(self.BUCKETS[name]):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+    def record_jobs(self, jobs, config, status, encode_seconds, peak_rss_kb=None, io=None):
+        """Record one JSON line per output of an ffmpeg run and refresh the textfile.
+
+        io is the run's measured (read_bytes, write_bytes); it is split over the outputs by size.
+        """
+        if not jobs:
+            return
+        sizes = [os.path.getsize(job.output_path)
+                 if status in ("ok", "cached") and os.path.exists(job.output_path) else 0 for job in jobs]
+        for job, output_size in zip(jobs, sizes):
+            input_size = os.path.getsize(job.input_path) if os.path.exists(job.input_path) else 0
+            share = output_size / sum(sizes) if sum(sizes) else 1 / len(jobs)
+            io_read, io_write = (None, None) if io is None or io[1] is None else (
+                int(io[0] * share), int(io[1] * share))
+            model_read, model_write = model_output_io(config, job, input_size, output_size)
+            record = {
+                "ts": round(time.time(), 3),
+                "input": job.input_path,
+                "output": job.output_path,
+                "status": status,
+                "codec": config.video_codec,
+                "encoder_preset": job.preset or config.encoder_preset,
+                "input_bytes": input_size,
+                "output_bytes": output_size,
+                "size_ratio": round(output_size / input_size, 4) if input_size and output_size else None,
+                "encode_seconds": round(encode_seconds, 3),
+                "media_seconds": round(job.duration, 3),
+                "realtime_factor": round(job.duration / encode_seconds, 3) if encode_seconds > 0 else None,
+                "peak_rss_kb": peak_rss_kb,
+                "mux_mode": config.mux_mode,
+                "io_read_bytes": io_read,
+                "io_write_bytes": io_write,
+                "io_model_read_bytes": model_read,
+                "io_model_write_bytes": model_write,
+                "params": {k: v for k, v in asdict(job).items() if k not in ("input_path", "output_path")},
+            }
+            with self.lock:
+                key = (status, config.video_codec)
+                self.jobs[key] = self.jobs.get(key, 0) + 1
+                if status == "ok":
+                    self.totals["input_bytes"] += input_size
+                    self.totals["output_bytes"] += output_size
+                    self.totals["encode_seconds"] += encode_seconds
+                    self.totals["media_seconds"] += job.duration
+                    self.totals["io_read_bytes"] += io_read or 0
+                    self.totals["io_write_bytes"] += io_write or 0
+                    self.totals["io_model_read_bytes"] += model_read
+                    self.totals["io_model_write_bytes"] += model_write
+                    self._observe("encode_seconds", encode_seconds)
+                    if record["realtime_factor"] is not None:
+                        self._observe("realtime_factor", record["realtime_factor"])
+                    if record["size_ratio"] is not None:
+                        self._observe("size_ratio", record["size_ratio"])
+                try:
+                    with open(metrics_jsonl_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError as e:
+                    logging.warning(f"Could not write metrics record: {e}")
+        self.write_prometheus()
+
+    def render_prometheus(self):
+        """Prometheus text exposition format for the current counters and histograms"""
+        prefix = "video_batch"
+        lines = [
+            f"# HELP {prefix}_jobs_total Finished ffmpeg outputs by status and codec.",
+            f"# TYPE {prefix}_jobs_total counter",
+        ]
+        with self.lock:
+            for (status, codec), count in sorted(self.jobs.items()):
+                lines.append(f'{prefix}_jobs_total{{status="{status}",codec="{codec}"}} {count}')
+            for name, value in self.totals.items():
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, hist in self.histograms.items():
+                lines.append(f"# TYPE {prefix}_job_{name} histogram")
+                for bound, count in zip(self.BUCKETS[name], hist["buckets"]):
+                    lines.append(f'{prefix}_job_{name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{prefix}_job_{name}_bucket{{le="+Inf"}} {hist["count"]}')
+                lines.append(f"{prefix}_job_{name}_sum {hist['sum']}")
+                lines.append(f"{prefix}_job_{name}_count {hist['count']}")
+            lines.append(f"# TYPE {prefix}_last_update_timestamp_seconds gauge")
+            lines.append(f"{prefix}_last_update_timestamp_seconds {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """Atomically replace the textfile so the node exporter never reads a partial file"""
+        if not prometheus_textfile_path:
+            return
+        tmp_path = prometheus_textfile_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, prometheus_textfile_path)
+        except OSError as e:
+            logging.warning(f"Could not write Prometheus textfile: {e}")
+
+batch_metrics = BatchMetrics()
+
+class PresetController:
+    """Chooses x264/x265 presets and thread counts for the remaining queue from measured throughput"""
+
+    def __init__(self, base_preset, workers, total_jobs=None, deadline=None, min_realtime=None):
+        self.lock = threading.Lock()
+        self.base_preset = base_preset
+        self.workers = workers
+        self.total_jobs = total_jobs
+        self.deadline = deadline
+        self.min_realtime = min_realtime
+        self.start = time.time()
+        self.done = 0              # jobs that left the queue: encoded, failed or rejected in preflight
+        self.running = 0
+        self.held = 0              # threads handed to running jobs
+        self.finished = 0
+        self.media_seconds = 0.0   # sum over finished jobs, for the average job length
+        self.rtf = {}              # preset -> moving average realtime factor per job
+
+    def observe(self, preset, media_seconds, encode_seconds):
+        if encode_seconds <= 0:
+            return
+        factor = media_seconds / encode_seconds
+        with self.lock:
+            self.finished += 1
+            self.media_seconds += media_seconds
+            previous = self.rtf.get(preset)
+            self.rtf[preset] = factor if previous is None else 0.7 * previous + 0.3 * factor
+
+    def estimate(self, preset):
+        """Measured realtime factor, or one scaled from the nearest measured preset via the priors"""
+        if preset in self.rtf:
+            return self.rtf[preset]
+        if not self.rtf:
+            return None
+        measured = min(self.rtf, key=lambda p: abs(PRESET_LADDER.index(p) - PRESET_LADDER.index(preset))
+                       if p in PRESET_LADDER else len(PRESET_LADDER))
+        ratio = PRESET_SPEED_PRIOR.get(preset, 1.0) / PRESET_SPEED_PRIOR.get(measured, 1.0)
+        return self.rtf[measured] * ratio
+
+    def required_realtime(self, media_seconds):
+        """Per-job realtime factor needed to hit the target (None when there is no target)"""
+        required = self.min_realtime
+        if self.deadline is not None and self.total_jobs:
+            remaining_jobs = max(1, self.total_jobs - self.done)
+            average = self.media_seconds / self.finished if self.finished else media_seconds
+            time_left = max(1.0, self.deadline - (time.time() - self.start))
+            # The remaining media is shared by `workers` concurrent jobs
+            needed = remaining_jobs * average / time_left / max(1, min(self.workers, remaining_jobs))
+            required = needed if required is None else max(required, needed)
+        return required
+
+    def choose(self, media_seconds, threads):
+        """Return (preset, threads) for the next job; the threads are held until release()"""
+        with self.lock:
+            remaining = (self.total_jobs - self.done) if self.total_jobs else self.workers
+            # Give idle cores to the tail of the queue once fewer jobs than workers remain,
+            # shared between this job and the ones not started yet
+            if threads and remaining < self.workers:
+                idle = available_cpus() - self.held
+                threads = max(threads, idle // max(1, remaining - self.running))
+            self.running += 1
+            self.held += threads
+            required = self.required_realtime(media_seconds)
+            if required is None or not self.rtf:
+                return self.base_preset, threads
+            chosen = PRESET_LADDER[0]
+            for preset in PRESET_LADDER:
+                estimate = self.estimate(preset)
+                # 15% headroom so noisy measurements don't push us past the target
+                if estimate is not None and estimate >= required * 1.15:
+                    chosen = preset
+            return chosen, threads
+
+    def release(self, threads):
+        """A job from choose() has finished (successfully or not)"""
+        with self.lock:
+            self.running -= 1
+            self.held -= threads
+            self.done += 1
+
+    def skip(self):
+        """An input left the queue without reaching choose() (e.g. rejected in preflight)"""
+        with self.lock:
+            self.done += 1
+
+preset_controller = None
+
+def choose_preset(config, media_seconds, threads):
+    """(preset, threads) for the next job; the configured preset unless a controller is active"""
+    if preset_controller is None or config.video_codec == 'prores_apple':
+        return None, threads
+    preset, threads = preset_controller.choose(media_seconds, threads)
+    required = preset_controller.required_realtime(media_seconds)
+    if required is not None:
+        estimate = preset_controller.estimate(preset)
+        print(f"   🎚️ Preset: {preset} (need ≥{required:.2f}x realtime"
+              + (f", est. {estimate:.2f}x)" if estimate else ")"))
+    return preset, threads
+
+@contextmanager
+def preset_slot(config, media_seconds, threads):
+    """choose_preset for the wrapped job, holding its threads in the controller until the block exits"""
+    preset, threads = choose_preset(config, media_seconds, threads)
+    try:
+        yield preset, threads
+    finally:
+        if preset_controller is not None and config.video_codec != 'prores_apple':
+            preset_controller.release(threads)
+
+def observe_throughput(jobs, config, encode_seconds):
+    """Feed a finished encode's realtime factor back to the controller"""
+    if preset_controller is None or not jobs or config.video_codec == 'prores_apple' or jobs[0].remux_codec:
+        return
+    preset = jobs[0].preset or config.encoder_preset
+    preset_controller.observe(preset, sum(job.duration for job in jobs), encode_seconds)
+
+def estimate_job_memory(config, jobs, check=None):
+    """Estimated peak RSS (bytes) of the ffmpeg process writing these jobs, before correction.
+
+    Runtime and demuxer baseline, decoder/filter frames at source size, the encoder's frame
+    buffers at output size, and a full -max_muxing_queue_size of packets.
+    """
+    src_w, src_h = check.size if check is not None and check.size else (1920, 1080)
+    total = 64 * 1024 * 1024
+    if jobs[0].remux_codec:
+        return total + 16 * 1024 * 1024  # packets only, no frames decoded
+    total += src_w * src_h * 1.5 * 16
+    bytes_per_pixel, frames, _ = CODEC_FOOTPRINT.get(config.video_codec, CODEC_FOOTPRINT["h264"])
+    for job in jobs:
+        out_w, out_h = job.frame_size or (src_w, src_h)
+        total += out_w * out_h * bytes_per_pixel * frames
+        if config.video_codec == 'prores_apple':
+            # The random H.264 bitrate isn't used; ProRes packets scale with the profile and frame size
+            packet = out_w * out_h * PRORES_BITS_PER_PIXEL.get(str(config.prores_profile), 3.54) / 8
         else:
-            print("❌ No output file created")
-            return False, process_time
-    except subprocess.TimeoutExpired:
-        print("❌ Timeout (3min)")
-        return False, 180
-    except Exception as e:
-        print(f"❌ Exception: {e}")
-        logging.error(f"Exception processing {os.path.basename(input_path)}: {str(e)}")
+            packet = job.video_bitrate * 125 / max(1, job.framerate)
+        total += 1024 * packet
+    return int(total)
+
+@dataclass
+class AdmissionTicket:
+    ticket_id: int
+    key: str
+    raw_estimate: int   # bytes, from estimate_job_memory
+    estimate: int       # bytes, after the learned correction
+    cpu: float
+    processes: int = 1  # concurrent ffmpeg processes the estimate covers (segment mode)
+    waited: float = 0.0
+
+class AdmissionController:
+    """Lets an encode start only while the projected memory and CPU of running encodes fit the budget.
+
+    At least one encode is always admitted, so an oversized job runs alone instead of never.
+    """
+
+    def __init__(self, limits, model_path=None):
+        self.cond = threading.Condition()
+        self.limits = limits
+        self.memory_budget = int(limits.memory_bytes * admission_memory_fraction) if limits.memory_bytes else None
+        self.cpu_budget = limits.cpus * admission_cpu_overcommit
+        self.baseline = limits.memory_used() or 0
+        self.running = {}
+        self.next_id = 0
+        self.model_path = model_path
+        self.corrections = {}
+        if model_path and os.path.exists(model_path):
+            try:
+                with open(model_path, 'r', encoding='utf-8') as f:
+                    self.corrections = json.load(f)
+            except (OSError, ValueError):
+                self.corrections = {}
+
+    def fits(self, memory, cpu):
+        used_memory = sum(t.estimate for t in self.running.values())
+        used_cpu = sum(t.cpu for t in self.running.values())
+        if used_cpu + cpu > self.cpu_budget:
+            return False
+        if self.memory_budget is None:
+            return True
+        # Projected use, or what is really in use when other processes grew meanwhile
+        in_use = max(self.baseline + used_memory, self.limits.memory_used() or 0)
+        return in_use + memory <= self.memory_budget
+
+    def admit(self, key, raw_estimate, cpu, name, processes=1):
+        """Block until the job fits; returns its AdmissionTicket"""
+        estimate = int(raw_estimate * self.corrections.get(key, 1.0))
+        start = time.time()
+        waiting = False
+        with self.cond:
+            while self.running and not self.fits(estimate, cpu):
+                if not waiting:
+                    print(f"   🚦 Waiting for resources: {name} needs ~{estimate // (1024 * 1024)}MB")
+                    waiting = True
+                self.cond.wait(5)
+            ticket = AdmissionTicket(self.next_id, key, raw_estimate, estimate, cpu, processes,
+                                     time.time() - start)
+            self.next_id += 1
+            self.running[ticket.ticket_id] = ticket
+        return ticket
+
+    def release(self, ticket, peak_rss_kb=None):
+        """Free the ticket's share and learn from the peak RSS the process reached"""
+        with self.cond:
+            self.running.pop(ticket.ticket_id, None)
+            self.cond.notify_all()
+        if not peak_rss_kb or not ticket.raw_estimate:
+            return
+        ratio = peak_rss_kb * 1024 * ticket.processes / ticket.raw_estimate
+        with self.cond:
+            previous = self.corrections.get(ticket.key)
+            self.corrections[ticket.key] = round(ratio if previous is None else 0.7 * previous + 0.3 * ratio, 4)
+            corrections = dict(self.corrections)
+        if self.model_path:
+            tmp_path = self.model_path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(corrections, f, indent=2)
+                os.replace(tmp_path, self.model_path)
+            except OSError as e:
+                logging.warning(f"Could not save admission model: {e}")
+
+_admission_controller = None
+_admission_lock = threading.Lock()
+
+def get_admission_controller():
+    """Process-wide AdmissionController (None when admission_control is off)"""
+    global _admission_controller
+    if not admission_control:
+        return None
+    with _admission_lock:
+        if _admission_controller is None:
+            limits = resource_limits()
+            _admission_controller = AdmissionController(limits, admission_model_path)
+            budget = _admission_controller.memory_budget
+            print(f"🚦 Admission control ({limits.source}): {limits.cpus:g} CPUs"
+                  + (f", {budget // (1024 * 1024)}MB for encodes" if budget else ""))
+        return _admission_controller
+
+def admit_encode(config, jobs, check, input_path):
+    """Wait until this input's encode fits the resource budget; returns a ticket or None"""
+    controller = get_admission_controller()
+    if controller is None:
+        return None
+    processes = plan_workers(0, segment_workers)[0] if should_segment(jobs) else 1
+    mode = "remux" if jobs[0].remux_codec else ("segmented" if processes > 1 else "encode")
+    raw_estimate = estimate_job_memory(config, jobs, check) * processes
+    _, _, cpu_weight = CODEC_FOOTPRINT.get(config.video_codec, CODEC_FOOTPRINT["h264"])
+    cpus = available_cpus()
+    threads = min(cpus, jobs[0].threads or cpus)
+    cpu = 0.5 if mode == "remux" else min(cpus, threads * processes) * cpu_weight
+    ticket = controller.admit(f"{config.video_codec}/{mode}", raw_estimate, cpu,
+                              os.path.basename(input_path), processes)
+    record_stage("admission", input_path, ticket.waited, estimate_mb=ticket.estimate // (1024 * 1024),
+                 cpu=round(cpu, 2), key=ticket.key)
+    return ticket
+
+def release_encode(ticket, result=None):
+    if ticket is not None:
+        get_admission_controller().release(ticket, result.peak_rss_kb if result is not None else None)
+
+def make_progress_printer(name, total_seconds):
+    """on_progress callback printing a throttled live status line for one job"""
+    last_print = [0.0]
+
+    def on_progress(info):
+        now = time.time()
+        if info.get("progress") == "end" or now - last_print[0] < progress_print_interval:
+            return
+        last_print[0] = now
+        out_us = info.get("out_time_us") or info.get("out_time_ms") or 0
+        out_time = max(out_us, 0) / 1_000_000
+        percent = min(100.0, 100.0 * out_time / total_seconds) if total_seconds else 0.0
+        print(f"   ⏳ {name}: {percent:.0f}% t={out_time:.1f}s "
+              f"fps={info.get('fps') or 0:.0f} speed={info.get('speed') or 0:.2f}x")
+
+    return on_progress
+
+def probe_keyframes(input_path):
+    """Video keyframe timestamps from packet flags (no decoding); empty list on failure"""
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", input_path]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    if result.returncode != 0:
+        return []
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags:
+            try:
+                keyframes.append(float(pts))
+            except ValueError:
+                continue
+    return sorted(keyframes)
+
+def plan_segments(job, keyframes):
+    """Split [ss, ss + duration) at the keyframes nearest each segment_target_seconds step.
+
+    Cut offsets are snapped to the output frame grid (1 / framerate) so the concatenated video
+    has exactly the frame count of a single-pass encode and stays in sync with the audio.
+    Returns [(start, length)] or [] when the range can't be split.
+    """
+    frame = 1.0 / job.framerate
+    end = job.ss + job.duration
+    cuts = [job.ss]
+    target = job.ss + segment_target_seconds
+    candidates = [k for k in keyframes if job.ss < k < end - segment_target_seconds / 2]
+    for keyframe in candidates:
+        if keyframe >= target:
+            snapped = job.ss + round((keyframe - job.ss) / frame) * frame
+            if snapped - cuts[-1] >= frame:
+                cuts.append(snapped)
+                target = snapped + segment_target_seconds
+    if len(cuts) < 2:
+        return []
+    cuts.append(end)
+    return [(round(a, 6), round(b - a, 6)) for a, b in zip(cuts, cuts[1:])]
+
+def should_segment(jobs):
+    return (segment_parallel and len(jobs) == 1 and not jobs[0].remux_codec
+            and jobs[0].duration > segment_min_duration)
+
+def encode_segmented(job, config):
+    """Encode one long job as parallel keyframe-aligned video segments plus one audio pass (if it has audio).
+
+    Returns an FFmpegRun aggregating all processes, or None when no split plan could be made
+    (the caller then falls back to the single-process encode).
+    """
+    segments = plan_segments(job, probe_keyframes(job.input_path))
+    if not segments:
+        return None
+    builder = get_command_builder(config)
+    workers, threads = plan_workers(len(segments) + (1 if job.filter_a else 0), segment_workers)
+    print(f"   🧩 Segment-parallel: {len(segments)} segments, {workers} at a time, {threads} threads each")
+    start_time = time.time()
+    work_dir = tempfile.mkdtemp(prefix=".segments_", dir=os.path.dirname(job.output_path) or ".")
+    try:
+        seg_paths = [os.path.join(work_dir, f"seg_{i:04d}.mov") for i in range(len(segments))]
+        audio_path = os.path.join(work_dir, "audio.m4a") if job.filter_a else None
+        commands = [builder.build_segment(job, start, length, path, threads)
+                    for (start, length), path in zip(segments, seg_paths)]
+        if audio_path:
+            commands.append(builder.build_audio_only(job, audio_path))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            runs = list(executor.map(lambda cmd: run_ffmpeg(cmd, stall_timeout=stall_timeout), commands))
+        failed = [run for run in runs if run.returncode != 0]
+        if not failed:
+            list_path = os.path.join(work_dir, "segments.txt")
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for path in seg_paths:
+                    escaped = os.path.abspath(path).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            runs.append(run_ffmpeg(builder.build_concat(job, list_path, audio_path), stall_timeout=stall_timeout,
+                                   duration=job.duration))
+        returncode = next((run.returncode for run in runs if run.returncode != 0), 0)
+        rss = [run.peak_rss_kb for run in runs if run.peak_rss_kb]
+        measured = [run for run in runs if run.write_bytes is not None]
+        return FFmpegRun(
+            returncode=returncode,
+            stderr="".join(run.stderr for run in runs),
+            elapsed=time.time() - start_time,
+            peak_rss_kb=max(rss) if rss else None,
+            progress={"segments": len(segments)},
+            read_bytes=sum(run.read_bytes for run in measured) if measured else None,
+            write_bytes=sum(run.write_bytes for run in measured) if measured else None,
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def variant_output_paths(output_path, count):
+    """Output paths for count variants: the first keeps output_path, the rest get _vN suffixes"""
+    root, ext = os.path.splitext(output_path)
+    return [output_path] + [f"{root}_v{i}{ext}" for i in range(2, count + 1)]
+
+def finalize_output(input_path, output_path, config, process_time):
+    """Report, vendor-patch and verify one finished output. Returns False if it is missing."""
+    if not os.path.exists(output_path):
+        print(f"❌ No output file created: {os.path.basename(output_path)}")
+        return False
+    output_size = os.path.getsize(output_path)
+    input_size = os.path.getsize(input_path)
+    size_ratio = output_size / input_size
+    print(f"✅ Success in {process_time:.1f}s: {os.path.basename(output_path)}")
+    print(f"   📊 Size: {input_size//1024}KB → {output_size//1024}KB ({size_ratio:.2f}x)")
+
+    # Optional: Patch vendor and verify metadata removal
+    if config.switches.get("force_vendor_patch", False):
+        with timed_stage("patch", input_path):
+            patched = patch_mov_vendor(output_path)
+        if patched:
+            print("   🔧 Patched MOV vendor_id: FFMP → appl")
+        else:
+            print("   🔧 Vendor patch skipped (marker not found)")
+    if config.switches["aggressive_metadata_removal"]:
+        with timed_stage("verify", input_path):
+            details = verify_metadata_removal(output_path)
+        # Print a compact one-liner of key details if available
+        if details:
+            brand = details.get("major_brand")
+            vtag = details.get("vendor_id_tag")
+            vctag = details.get("v_codec_tag_string")
+            vhdl = details.get("v_handler")
+            ahdl = details.get("a_handler")
+            summary_parts = []
+            if brand:
+                summary_parts.append(f"brand={brand}")
+            if vctag:
+                summary_parts.append(f"codec_tag={vctag}")
+            if vtag:
+                summary_parts.append(f"tag:vendor_id={vtag}")
+            if vhdl:
+                summary_parts.append(f"v_handler={vhdl}")
+            if ahdl:
+                summary_parts.append(f"a_handler={ahdl}")
+            if summary_parts:
+                print("   🧾 Details: " + ", ".join(summary_parts))
+    return True
+
+def source_size(probe):
+    """(width, height) of the first video stream, or None"""
+    video = probe.video if probe else None
+    if not video or not video.get("width") or not video.get("height"):
+        return None
+    return int(video["width"]), int(video["height"])
+
+def mark_remux(config, job):
+    """Switch a job to the stream-copy fast path when nothing but metadata has to change.
+
+    Needs the remux_fast_path switch, only the placeholder filters, and a source whose video
+    codec matches the configured one (so the output codec doesn't silently change).
+    """
+    if not config.switches.get("remux_fast_path", False) or config.video_codec not in REMUX_BITSTREAM_FILTERS:
+        return False
+    if job.filter_v != "format=yuv420p" or job.filter_a not in ("aformat=sample_fmts=fltp", None):
+        return False
+    probe = probe_video(job.input_path)
+    if probe is None or probe.video is None or probe.video.get("codec_name") != config.video_codec:
+        return False
+    job.remux_codec = config.video_codec
+    job.copy_audio = (probe.audio or {}).get("codec_name") in REMUX_AUDIO_COPY
+    print(f"   ⏩ Remux: no filters active, stream copy + SEI scrub ({job.remux_codec}"
+          f"{', audio copied' if job.copy_audio else ''})")
+    return True
+
+def plan_outputs(config, input_path, output_path, video_duration, threads=0, variants=1, rng=random,
+                 preset=None, check=None):
+    """Resolve the JobSpecs for one input and build the ffmpeg argv that produces them"""
+    builder = get_command_builder(config)
+    size = None
+    if check is None and config.optimize_filters:
+        size = source_size(probe_video(input_path))
+    if variants > 1:
+        jobs = []
+        for i, path in enumerate(variant_output_paths(output_path, variants), 1):
+            print(f"   🎞️ Variant {i}/{variants}: {os.path.basename(path)}")
+            jobs.append(resolve_job(config, input_path, path, video_duration, threads, rng, preset, size, check))
+        # The multi-output command seeks once, to the first variant's start; keep each variant's
+        # end trim and record the start it really gets
+        shared_ss = jobs[0].ss
+        jobs = [replace(job, ss=shared_ss, duration=max(job.duration + job.ss - shared_ss, 3.0)) for job in jobs]
+        command = builder.build_multi(jobs)
+    else:
+        jobs = [resolve_job(config, input_path, output_path, video_duration, threads, rng, preset, size, check)]
+        mark_remux(config, jobs[0])
+        command = builder.build(jobs[0])
+    if config.switches["aggressive_metadata_removal"]:
+        print("   🛡️ Aggressive metadata removal enabled")
+    return jobs, command
+
+def process_video(input_path, output_path, threads=0, config=None, dry_run=None, variants=None):
+    """Enhanced video processing with aggressive metadata removal.
+
+    config defaults to the module settings; pass an EncodeConfig to run without globals.
+    With dry_run the ffmpeg command is printed instead of executed. With variants > 1 the
+    input is decoded once and fanned out to that many differently parameterised outputs.
+    """
+    config = config or EncodeConfig.from_globals()
+    dry_run = globals()["dry_run"] if dry_run is None else dry_run
+    variants = variants_per_input if variants is None else variants
+    print(f"⚡ Processing: {os.path.basename(input_path)}")
+
+    # Probe and preflight: reject unusable inputs before any encode
+    with timed_stage("probe", input_path):
+        probe = probe_video(input_path)
+    check = run_preflight(input_path, probe)
+    if not check.ok:
         return False, 0
+    video_duration = check.duration
+
+    # Generate output path
+    unique_output = output_path or make_output_path(input_path, config.output_folder)
+    with preset_slot(config, video_duration * variants, threads) as (preset, threads):
+        jobs, command = plan_outputs(config, input_path, unique_output, video_duration, threads, variants,
+                                     job_rng(input_path, config), preset, check)
+        outputs = [job.output_path for job in jobs]
+        if dry_run:
+            print(f"   🧪 Dry run: {shlex.join(command)}")
+            return True, 0
+        cache_key = reuse_cached_encode(input_path, jobs, config)
+        if cache_key is True:
+            return True, 0
+
+        # Execute command once the resource budget allows it
+        ticket = admit_encode(config, jobs, check, input_path)
+        start_time = time.time()
+        result = None
+        try:
+            on_progress = make_progress_printer(os.path.basename(input_path), max(j.duration for j in jobs))
+            try:
+                result = encode_segmented(jobs[0], config) if should_segment(jobs) else None
+                if result is None:
+                    result = run_ffmpeg(command, stall_timeout=stall_timeout, on_progress=on_progress,
+                                        duration=max(j.duration for j in jobs))
+            finally:
+                release_encode(ticket, result)
+            process_time = result.elapsed
+            progress = result.progress or {}
+            record_stage("encode", input_path, process_time, returncode=result.returncode,
+                         fps=progress.get("fps"), speed=progress.get("speed"),
+                         out_time_us=progress.get("out_time_us"), peak_rss_kb=result.peak_rss_kb,
+                         read_bytes=result.read_bytes, write_bytes=result.write_bytes, mux_mode=config.mux_mode)
+            if result.returncode != 0:
+                print(f"❌ Error: {result.stderr[-200:]}")
+                logging.error(f"FFmpeg error for {os.path.basename(input_path)}: {result.stderr}")
+                batch_metrics.record_jobs(jobs, config, "ffmpeg_error", process_time, result.peak_rss_kb,
+                                          (result.read_bytes, result.write_bytes))
+                return False, process_time
+            finished = [finalize_output(input_path, path, config, process_time) for path in outputs]
+            batch_metrics.record_jobs(jobs, config, "ok" if all(finished) else "no_output",
+                                      process_time, result.peak_rss_kb, (result.read_bytes, result.write_bytes))
+            observe_throughput(jobs, config, process_time)
+            if cache_key and all(finished):
+                encode_cache.store(cache_key, outputs)
+            return all(finished), process_time
+        except FFmpegStalled:
+            process_time = time.time() - start_time
+            print(f"❌ Stalled: no progress for {stall_timeout}s")
+            logging.error(f"FFmpeg stalled for {os.path.basename(input_path)} after {process_time:.1f}s")
+            record_stage("encode", input_path, process_time, returncode=None, stalled=True)
+            batch_metrics.record_jobs(jobs, config, "stalled", process_time)
+            return False, process_time
+        except Exception as e:
+            print(f"❌ Exception: {e}")
+            logging.error(f"Exception processing {os.path.basename(input_path)}: {str(e)}")
+            batch_metrics.record_jobs(jobs, config, "exception", time.time() - start_time)
+            return False, 0
+
+class AdaptiveLimiter:
+    """asyncio concurrency limit that can be resized while jobs are waiting"""
+
+    def __init__(self, limit, min_limit=1, max_limit=None):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.active = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    async def set_limit(self, limit):
+        async with self.cond:
+            self.limit = max(self.min_limit, min(self.max_limit, limit))
+            self.cond.notify_all()
+
+    async def autotune(self, interval):
+        """Shrink the limit when the 1-minute load per core is high, grow it while cores idle"""
+        if not hasattr(os, "getloadavg"):
+            return
+        cpus = available_cpus()
+        while True:
+            await asyncio.sleep(interval)
+            load = os.getloadavg()[0] / cpus
+            low, high = async_load_target
+            if load > high and self.limit > self.min_limit:
+                await self.set_limit(self.limit - 1)
+                print(f"🔽 Load {load:.2f}/core → concurrency {self.limit}")
+            elif load < low and self.limit < self.max_limit and self.active >= self.limit:
+                await self.set_limit(self.limit + 1)
+                print(f"🔼 Load {load:.2f}/core → concurrency {self.limit}")
+
+async def async_probe(path):
+    """Async counterpart of probe_video (same on-disk probe cache)"""
+    key, cached = cached_probe(path)
+    if cached is None and key is not None:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *probe_command(path), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        except OSError:
+            return None
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), 10)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None
+        if proc.returncode == 0:
+            cached = store_probe(key, stdout.decode("utf-8", errors="replace"))
+    return cached
+
+async def async_encode(input_path, output_path, check, threads, config, limiter, variants=1):
+    """Encode one preflighted input while holding a limiter slot, then patch/verify outside the slot"""
+    print(f"⚡ Processing: {os.path.basename(input_path)}")
+    unique_output = output_path or make_output_path(input_path, config.output_folder)
+    rng = await asyncio.to_thread(job_rng, input_path, config)
+    video_duration = check.duration
+    with preset_slot(config, video_duration * variants, threads) as (preset, threads):
+        jobs, command = plan_outputs(config, input_path, unique_output, video_duration, threads, variants, rng,
+                                     preset, check)
+        outputs = [job.output_path for job in jobs]
+        cache_key = await asyncio.to_thread(reuse_cached_encode, input_path, jobs, config)
+        if cache_key is True:
+            return True, 0
+        await limiter.acquire()
+        ticket = await asyncio.to_thread(admit_encode, config, jobs, check, input_path)
+        start_time = time.time()
+        result = None
+        try:
+            on_progress = make_progress_printer(os.path.basename(input_path), max(j.duration for j in jobs))
+            if should_segment(jobs):
+                result = await asyncio.to_thread(encode_segmented, jobs[0], config)
+            if result is None:
+                # run_ffmpeg (not create_subprocess_exec) so the encode's peak RSS and I/O come back via wait4
+                result = await asyncio.to_thread(run_ffmpeg, command, stall_timeout=stall_timeout,
+                                                 on_progress=on_progress, duration=max(j.duration for j in jobs))
+        except FFmpegStalled:
+            process_time = time.time() - start_time
+            print(f"❌ Stalled: no progress for {stall_timeout}s")
+            logging.error(f"FFmpeg stalled for {os.path.basename(input_path)} after {process_time:.1f}s")
+            record_stage("encode", input_path, process_time, returncode=None, stalled=True)
+            batch_metrics.record_jobs(jobs, config, "stalled", process_time)
+            return False, process_time
+        except Exception as e:
+            print(f"❌ Exception: {e}")
+            logging.error(f"Exception processing {os.path.basename(input_path)}: {str(e)}")
+            batch_metrics.record_jobs(jobs, config, "exception", time.time() - start_time)
+            return False, 0
+        finally:
+            release_encode(ticket, result)
+            await limiter.release()
+
+    process_time = result.elapsed
+    progress = result.progress or {}
+    record_stage("encode", input_path, process_time, returncode=result.returncode,
+                 fps=progress.get("fps"), speed=progress.get("speed"),
+                 out_time_us=progress.get("out_time_us"), peak_rss_kb=result.peak_rss_kb,
+                 read_bytes=result.read_bytes, write_bytes=result.write_bytes, mux_mode=config.mux_mode)
+    if result.returncode != 0:
+        print(f"❌ Error: {result.stderr[-200:]}")
+        logging.error(f"FFmpeg error for {os.path.basename(input_path)}: {result.stderr}")
+        batch_metrics.record_jobs(jobs, config, "ffmpeg_error", process_time, result.peak_rss_kb,
+                                  (result.read_bytes, result.write_bytes))
+        return False, process_time
+    # Patch + verify are I/O bound; run them off the loop so the next encode starts now
+    finished = []
+    for path in outputs:
+        finished.append(await asyncio.to_thread(finalize_output, input_path, path, config, process_time))
+    batch_metrics.record_jobs(jobs, config, "ok" if all(finished) else "no_output",
+                              process_time, result.peak_rss_kb, (result.read_bytes, result.write_bytes))
+    observe_throughput(jobs, config, process_time)
+    if cache_key and all(finished):
+        await asyncio.to_thread(encode_cache.store, cache_key, outputs)
+    return all(finished), process_time
+
+async def run_async_batch(input_paths, threads, concurrency, manifest=None, settings_hash=None, digests=None):
+    """Probe ahead, encode under an adaptive limit and verify behind.
+
+    input_paths may be any iterable (e.g. a discovery generator); it is consumed off the
+    event loop. Probing runs at most queue-size files ahead of the encoders (backpressure).
+    Returns [(input_path, (success, seconds))] in input order.
+    """
+    config = EncodeConfig.from_globals()
+    max_limit = async_max_workers or concurrency * 2
+    limiter = AdaptiveLimiter(concurrency, max_limit=max_limit)
+    # Every limiter slot blocks a worker thread for its admission wait and encode; keep spare
+    # threads for discovery, hashing and patch/verify
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_limit + 4))
+    queue = asyncio.Queue(maxsize=max(2, concurrency * 2))
+    results = {}
+    digests = {} if digests is None else digests
+    paths = iter(input_paths)
+
+    async def producer():
+        index = 0
+        while True:
+            input_path = await asyncio.to_thread(next, paths, None)
+            if input_path is None:
+                break
+            results[index] = (input_path, (False, 0))
+            with timed_stage("probe", input_path):
+                probe = await async_probe(input_path)
+            with job_output(input_path):
+                check = run_preflight(input_path, probe)
+            if not check.ok:
+                if manifest is not None:
+                    status, error = manifest_outcome(input_path, False)
+                    manifest.mark(input_path, status, digests.get(input_path), settings_hash,
+                                  make_output_path(input_path, config.output_folder), error)
+                index += 1
+                continue
+            await queue.put((index, input_path, check))
+            index += 1
+        for _ in range(max_limit):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, input_path, check = item
+            output_path = make_output_path(input_path, config.output_folder)
+            digest = digests.get(input_path)
+            if manifest is not None:
+                manifest.mark(input_path, "running", digest, settings_hash, output_path)
+            with job_output(input_path):
+                result = await async_encode(input_path, output_path, check, threads,
+                                            config, limiter, variants_per_input)
+            results[index] = (input_path, result)
+            if manifest is not None:
+                status, error = manifest_outcome(input_path, result[0])
+                manifest.mark(input_path, status, digest, settings_hash, output_path, error)
+
+    tuner = asyncio.ensure_future(limiter.autotune(async_adjust_interval))
+    try:
+        await asyncio.gather(producer(), *(worker() for _ in range(max_limit)))
+    finally:
+        tuner.cancel()
+    return [results[index] for index in sorted(results)]
+
+def find_encoder_banners(file_path, limit=None):
+    """Encoder banner strings (e.g. x264 SEI user data) found in the first `limit` bytes of a file"""
+    limit = banner_scan_bytes if limit is None else limit
+    overlap = max(len(banner) for banner in ENCODER_BANNERS)
+    found = set()
+    tail = b""
+    with open(file_path, "rb") as f:
+        read = 0
+        while read < limit:
+            chunk = f.read(min(1024 * 1024, limit - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            window = tail + chunk
+            found.update(banner.decode() for banner in ENCODER_BANNERS if banner in window)
+            tail = window[-overlap:]
+    return sorted(found)
 
 def verify_metadata_removal(file_path):
     """Verify that metadata has been removed. Only flag non-empty values.
 
     Returns a dict with selected details to report upstream.
     """
+    probe = probe_video(file_path, use_cache=False)
+    if probe is None:
+        return None  # Silent fail for verification
+    suspicious_keys = {"encoder", "compressor", "software", "creation_time"}
+    found_nonempty = []
+    tag_sets = [probe.format_tags] + [probe.stream_tags(stream) for stream in probe.streams]
+    for tags in tag_sets:
+        for key, val in tags.items():
+            if key in suspicious_keys and val:
+                found_nonempty.append(f"{key}={val}")
+    video_tags = probe.stream_tags(probe.video)
+    audio_tags = probe.stream_tags(probe.audio)
+    # ffprobe exports the MOV sample entry vendor as tag:vendor_id; FFMP marks FFmpeg
+    vendor_id_tag = video_tags.get("vendor_id")
+    if vendor_id_tag == "FFMP":
+        found_nonempty.append(f"vendor_id={vendor_id_tag}")
+    found_nonempty.extend(f"bitstream:{banner}" for banner in find_encoder_banners(file_path))
+    if found_nonempty:
+        print(f"   ⚠️ Some metadata may remain: {found_nonempty}")
+    else:
+        print(f"   ✅ Metadata removal verified")
+    # Show MOV vendor tag when present (informational)
+    if vendor_id_tag is not None:
+        print(f"   ℹ️ MOV tag:vendor_id = {vendor_id_tag}")
+    return {
+        "vendor_id_tag": vendor_id_tag,
+        "major_brand": probe.format_tags.get("major_brand"),
+        "minor_version": probe.format_tags.get("minor_version"),
+        "compatible_brands": probe.format_tags.get("compatible_brands"),
+        "v_handler": video_tags.get("handler_name"),
+        "a_handler": audio_tags.get("handler_name"),
+        "v_codec_tag_string": (probe.video or {}).get("codec_tag_string"),
+    }
+
+def wanted_by_name(rel_path):
+    """Extension plus include/exclude glob check on a path relative to input_folder"""
+    rel_path = rel_path.replace(os.sep, "/")
+    if Path(rel_path).suffix.lower() not in VIDEO_EXTENSIONS:
+        return False
+    if not any(fnmatch.fnmatch(rel_path, pattern) for pattern in discover_include):
+        return False
+    return not any(fnmatch.fnmatch(rel_path, pattern) for pattern in discover_exclude)
+
+def wanted_by_stat(st):
+    """Size and mtime filters"""
+    if st.st_size < discover_min_bytes:
+        return False
+    if discover_max_bytes is not None and st.st_size > discover_max_bytes:
+        return False
+    if discover_newer_than is not None and st.st_mtime <= discover_newer_than:
+        return False
+    if discover_older_than is not None and st.st_mtime >= discover_older_than:
+        return False
+    return True
+
+def discover_inputs(folder, recursive=None):
+    """Yield input video paths as os.scandir finds them (depth-first, no full listing up front)"""
+    recursive = discover_recursive if recursive is None else recursive
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                subdirs = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                subdirs.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        if wanted_by_name(os.path.relpath(entry.path, folder)) and wanted_by_stat(entry.stat()):
+                            yield entry.path
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"Cannot scan {current}: {e}")
+            continue
+        # Reversed so subfolders are visited in the order scandir returned them
+        stack.extend(reversed(subdirs))
+
+def content_hash(path, chunk_size=1024 * 1024):
+    """BLAKE2b digest of the file contents"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def current_settings():
+    """All settings that influence an encode, as a JSON-serialisable dict"""
+    settings = EncodeConfig.from_globals().settings()
+    settings["variants_per_input"] = variants_per_input
+    return settings
+
+def settings_fingerprint(settings=None):
+    """Stable hash of the encode settings"""
+    settings = current_settings() if settings is None else settings
+    blob = json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(blob).hexdigest()
+
+def rejection_fingerprint(settings_hash):
+    """Settings hash for preflight rejections: the encode settings plus the preflight checks"""
+    return settings_fingerprint({
+        "settings": settings_hash,
+        "preflight": [PREFLIGHT_VERSION, preflight_min_duration, preflight_truncation_ratio],
+    })
+
+_digest_memo = {}
+_digest_lock = threading.Lock()
+
+def cached_content_hash(path):
+    """content_hash memoised per (path, size, mtime) for the lifetime of the process"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_memo.get(key)
+    if digest is None:
+        digest = content_hash(path)
+        with _digest_lock:
+            _digest_memo[key] = digest
+    return digest
+
+def job_rng(input_path, config):
+    """RNG for an input's random parameters; seeded from content + settings when the encode cache is on"""
+    if not encode_cache_enabled:
+        return random
+    return random.Random(f"{cached_content_hash(input_path)}:{settings_fingerprint(config.settings())}")
+
+def encode_cache_key(input_path, jobs, config):
+    """Key = input content hash + codec config + every resolved job parameter"""
+    payload = {
+        "content": cached_content_hash(input_path),
+        "settings": config.settings(),
+        "jobs": [{k: v for k, v in asdict(job).items() if k not in ("input_path", "output_path", "threads")}
+                 for job in jobs],
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst (same volume), falling back to a copy"""
+    if os.path.exists(dst):
+        os.remove(dst)
     try:
-        cmd = f'ffprobe -v quiet -show_format -show_streams "{file_path}"'
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            output = result.stdout
-            suspicious_keys = {"encoder", "vendor_id", "compressor", "software", "creation_time"}
-            found_nonempty = []
-            vendor_id_tag = None
-            major_brand = None
-            minor_version = None
-            compatible_brands = None
-            v_handler = None
-            a_handler = None
-            v_codec_tag_string = None
-            for line in output.splitlines():
-                # print(line)
-                if "=" in line:
-                    key, val = line.split("=", 1)
-                    # print(key, val)
-                    key = key.strip().lower()
-                    # print(key)
-                    val = val.strip()
-                    if key in suspicious_keys and val:
-                        found_nonempty.append(f"{key}={val}")
-                    # Capture ffprobe-exported tag name for mov vendor id
-                    if key == "tag:vendor_id":
-                        vendor_id_tag = val
-                    elif key == "tag:major_brand":
-                        major_brand = val
-                    elif key == "tag:minor_version":
-                        minor_version = val
-                    elif key == "tag:compatible_brands":
-                        compatible_brands = val
-                    elif key == "tag:handler_name":
-                        # first occurrence is usually video; store both when seen
-                        if v_handler is None:
-                            v_handler = val
-                        elif a_handler is None:
-                            a_handler = val
-                    elif key == "codec_tag_string" and v_codec_tag_string is None:
-                        # first stream printed by ffprobe is usually video
-                        v_codec_tag_string = val
-            if found_nonempty:
-                print(f"   ⚠️ Some metadata may remain: {found_nonempty}")
-            else:
-                print(f"   ✅ Metadata removal verified")
-            # Show MOV vendor tag when present (informational)
-            if vendor_id_tag is not None:
-                print(f"   ℹ️ MOV tag:vendor_id = {vendor_id_tag}")
-            return {
-                "vendor_id_tag": vendor_id_tag,
-                "major_brand": major_brand,
-                "minor_version": minor_version,
-                "compatible_brands": compatible_brands,
-                "v_handler": v_handler,
-                "a_handler": a_handler,
-                "v_codec_tag_string": v_codec_tag_string,
-            }
-    except:
-        pass  # Silent fail for verification
-    return None
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class EncodeCache:
+    """Finished outputs stored as <root>/<key>/<n>.mov, evicted least-recently-used above max_bytes"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = None  # key -> [bytes, last_used]
+
+    def _load(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                self.index[entry.name] = [size, entry.stat().st_mtime]
+
+    def _drop(self, key):
+        self.index.pop(key, None)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def fetch(self, key, outputs):
+        """Link a cached entry to outputs; True only when every output was restored"""
+        with self.lock:
+            self._load()
+            if key not in self.index:
+                return False
+            entry = os.path.join(self.root, key)
+            sources = [os.path.join(entry, f"{i}.mov") for i in range(len(outputs))]
+            if not all(os.path.exists(src) for src in sources):
+                self._drop(key)
+                return False
+            for src, dst in zip(sources, outputs):
+                link_or_copy(src, dst)
+            now = time.time()
+            os.utime(entry, (now, now))
+            self.index[key][1] = now
+            return True
+
+    def store(self, key, outputs):
+        """Add finished outputs under key, then evict old entries over the size limit"""
+        with self.lock:
+            self._load()
+            entry = os.path.join(self.root, key)
+            tmp_entry = entry + ".tmp"
+            try:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                os.makedirs(tmp_entry)
+                for i, path in enumerate(outputs):
+                    link_or_copy(path, os.path.join(tmp_entry, f"{i}.mov"))
+                shutil.rmtree(entry, ignore_errors=True)
+                os.replace(tmp_entry, entry)
+            except OSError as e:
+                logging.warning(f"Could not store encode cache entry: {e}")
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                return
+            self.index[key] = [sum(os.path.getsize(p) for p in outputs), time.time()]
+            total = sum(size for size, _ in self.index.values())
+            while total > self.max_bytes and self.index:
+                oldest = min(self.index, key=lambda k: self.index[k][1])
+                total -= self.index[oldest][0]
+                self._drop(oldest)
+
+encode_cache = EncodeCache(encode_cache_dir, encode_cache_max_bytes)
+
+def reuse_cached_encode(input_path, jobs, config):
+    """Return True when the outputs were restored from the encode cache, else the key to store
+    under after encoding (None when the cache is disabled)"""
+    if not encode_cache_enabled:
+        return None
+    try:
+        key = encode_cache_key(input_path, jobs, config)
+        if encode_cache.fetch(key, [job.output_path for job in jobs]):
+            print(f"♻️ Reused cached encode for identical input: {os.path.basename(jobs[0].output_path)}")
+            batch_metrics.record_jobs(jobs, config, "cached", 0.0)
+            return True
+        return key
+    except OSError as e:
+        logging.warning(f"Encode cache unavailable for {os.path.basename(input_path)}: {e}")
+        return None
+
+class JobManifest:
+    """SQLite record of every input: content hash, settings, output path and status"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                input_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                content_hash TEXT,
+                settings_hash TEXT,
+                settings_json TEXT,
+                output_path TEXT,
+                status TEXT,
+                error TEXT,
+                updated_at REAL
+            )""")
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def lookup(self, input_path):
+        with self.lock:
+            return self.db.execute(
+                "SELECT size, mtime_ns, content_hash, settings_hash, output_path, status "
+                "FROM jobs WHERE input_path = ?", (os.path.abspath(input_path),)).fetchone()
+
+    def check(self, input_path, settings_hash):
+        """Return (needs_processing, content_hash) for an input.
+
+        The stored hash is reused when size and mtime are unchanged, so an unchanged
+        library is re-scanned with stat calls only.
+        """
+        st = os.stat(input_path)
+        row = self.lookup(input_path)
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[2]:
+            digest = row[2]
+        else:
+            digest = cached_content_hash(input_path)
+        if row and row[2] == digest and row[3] == settings_hash and row[5] == "done":
+            if row[4] and os.path.exists(row[4]):
+                return False, digest
+        # An unchanged file that failed the same preflight checks would only be rejected again (rows
+        # recorded after the file vanished have no size and are retried)
+        if (row and row[2] == digest and row[5] == "rejected" and row[0] is not None
+                and row[3] == rejection_fingerprint(settings_hash)):
+            return False, digest
+        return True, digest
+
+    def mark(self, input_path, status, digest, settings_hash, output_path=None, error=None, settings=None):
+        """Record a job row; an input that has disappeared since discovery is recorded without size/mtime"""
+        try:
+            st = os.stat(input_path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None
+        if status == "rejected":
+            settings_hash = rejection_fingerprint(settings_hash)
+        settings_json = json.dumps(settings if settings is not None else current_settings(),
+                                   sort_keys=True, default=str)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs (input_path, size, mtime_ns, content_hash, settings_hash, "
+                "settings_json, output_path, status, error, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(input_path), size, mtime_ns, digest, settings_hash,
+                 settings_json, output_path, status, error, time.time()))
+            self.db.commit()
+
+def run_manifest_job(input_path, threads, manifest, digest, settings_hash):
+    """process_video wrapper that records running/done/failed in the manifest"""
+    output_path = make_output_path(input_path)
+    if manifest is not None:
+        manifest.mark(input_path, "running", digest, settings_hash, output_path)
+    with job_output(input_path):
+        success, process_time = process_video(input_path, output_path, threads=threads)
+    if manifest is not None:
+        status, error = manifest_outcome(input_path, success)
+        manifest.mark(input_path, status, digest, settings_hash, output_path, error)
+    return success, process_time
+
+def manifest_outcome(input_path, success):
+    """(status, error) to record for a finished job; preflight rejections get their own status"""
+    reason = preflight_rejections.pop(input_path, None)
+    if success:
+        return "done", None
+    if reason:
+        return "rejected", reason
+    return "failed", "encode failed"
+
+class WorkQueue:
+    """Persistent FIFO of input paths (SQLite, stored next to the manifest).
+
+    Claims can carry a worker id and a lease; a lease that isn't renewed by heartbeat() expires and
+    the path goes back to the queue. Multi-node mode keeps the file on shared storage.
+    """
+
+    LEASE_COLUMNS = {"worker": "TEXT", "lease_expires": "REAL", "result": "TEXT", "reported": "INTEGER DEFAULT 0"}
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS work_queue (
+                input_path TEXT PRIMARY KEY,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                enqueued_at REAL,
+                updated_at REAL
+            )""")
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(work_queue)")}
+        for name, declaration in self.LEASE_COLUMNS.items():
+            if name not in existing:
+                self.db.execute(f"ALTER TABLE work_queue ADD COLUMN {name} {declaration}")
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def put(self, input_path):
+        """Queue a path; a path already being processed is left alone"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO work_queue (input_path, status, enqueued_at, updated_at) VALUES (?, 'queued', ?, ?) "
+                "ON CONFLICT(input_path) DO UPDATE SET status = 'queued', enqueued_at = excluded.enqueued_at, "
+                "updated_at = excluded.updated_at, attempts = 0, worker = NULL, lease_expires = NULL, "
+                "result = NULL, reported = 0 WHERE status != 'running'",
+                (os.path.abspath(input_path), now, now))
+            self.db.commit()
+
+    def claim(self, worker=None, lease=None):
+        """Mark the oldest queued path as running and return it (None when empty).
+
+        The conditional UPDATE makes the claim safe between processes sharing the file:
+        if another worker got the row first, the next one is tried.
+        """
+        if lease is not None:
+            self.requeue_expired()
+        with self.lock:
+            while True:
+                row = self.db.execute(
+                    "SELECT input_path FROM work_queue WHERE status = 'queued' ORDER BY enqueued_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                now = time.time()
+                claimed = self.db.execute(
+                    "UPDATE work_queue SET status = 'running', attempts = attempts + 1, updated_at = ?, "
+                    "worker = ?, lease_expires = ? WHERE input_path = ? AND status = 'queued'",
+                    (now, worker, now + lease if lease is not None else None, row[0])).rowcount
+                self.db.commit()
+                if claimed:
+                    return row[0]
+
+    def heartbeat(self, input_path, worker, lease):
+        """Extend a lease; False when the worker no longer holds it"""
+        with self.lock:
+            renewed = self.db.execute(
+                "UPDATE work_queue SET lease_expires = ?, updated_at = ? "
+                "WHERE input_path = ? AND worker = ? AND status = 'running'",
+                (time.time() + lease, time.time(), input_path, worker)).rowcount
+            self.db.commit()
+            return bool(renewed)
+
+    def finish(self, input_path, status, result=None, worker=None):
+        """Record the outcome; with a worker id only the current lease holder may finish"""
+        with self.lock:
+            done = self.db.execute(
+                "UPDATE work_queue SET status = ?, updated_at = ?, result = ?, lease_expires = NULL "
+                "WHERE input_path = ? AND (? IS NULL OR (worker = ? AND status = 'running'))",
+                (status, time.time(), json.dumps(result) if result is not None else None,
+                 os.path.abspath(input_path), worker, worker)).rowcount
+            self.db.commit()
+            return bool(done)
+
+    def requeue_running(self):
+        """Put entries interrupted by a previous shutdown back in the queue"""
+        with self.lock:
+            count = self.db.execute(
+                "UPDATE work_queue SET status = 'queued' WHERE status = 'running'").rowcount
+            self.db.commit()
+            return count
+
+    def requeue_expired(self, max_attempts=None):
+        """Return running entries whose lease ran out to the queue (or fail them after max_attempts)"""
+        max_attempts = queue_max_attempts if max_attempts is None else max_attempts
+        now = time.time()
+        with self.lock:
+            failed = self.db.execute(
+                "UPDATE work_queue SET status = 'failed', result = ?, updated_at = ? WHERE status = 'running' "
+                "AND lease_expires IS NOT NULL AND lease_expires < ? AND attempts >= ?",
+                (json.dumps({"error": f"lease expired {max_attempts} times"}), now, now, max_attempts)).rowcount
+            count = self.db.execute(
+                "UPDATE work_queue SET status = 'queued', worker = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE status = 'running' AND lease_expires IS NOT NULL AND lease_expires < ?",
+                (now, now)).rowcount
+            self.db.commit()
+            return count + failed
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM work_queue GROUP BY status").fetchall())
+
+    def collect_finished(self):
+        """Finished entries not yet reported to the coordinator: [(input_path, status, result dict)]"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT input_path, status, result FROM work_queue "
+                "WHERE status NOT IN ('queued', 'running') AND reported = 0").fetchall()
+            self.db.executemany("UPDATE work_queue SET reported = 1 WHERE input_path = ?",
+                                [(row[0],) for row in rows])
+            self.db.commit()
+        return [(path, status, json.loads(result) if result else {}) for path, status, result in rows]
+
+class StableFileTracker:
+    """Holds candidate files until their size and mtime stop changing (finished being written)"""
+
+    def __init__(self, stable_seconds):
+        self.stable_seconds = stable_seconds
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> ((size, mtime_ns), unchanged_since) or None
+
+    def touch(self, path):
+        if wanted_by_name(os.path.relpath(path, input_folder)):
+            with self.lock:
+                self.pending[path] = None
+
+    def ready(self):
+        """Return the files whose size/mtime have been unchanged for stable_seconds"""
+        now = time.time()
+        stable = []
+        with self.lock:
+            for path, seen in list(self.pending.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    del self.pending[path]
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if seen is None or seen[0] != signature:
+                    self.pending[path] = (signature, now)
+                elif now - seen[1] >= self.stable_seconds and st.st_size > 0:
+                    if wanted_by_stat(st):
+                        stable.append(path)
+                    del self.pending[path]
+        return stable
+
+def start_watch_observer(folder, tracker):
+    """Watch folder with inotify via the optional watchdog package; None means fall back to polling"""
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_created(self, event):
+            if not event.is_directory:
+                tracker.touch(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                tracker.touch(event.src_path)
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                tracker.touch(event.dest_path)
+
+    observer = Observer()
+    observer.schedule(Handler(), folder, recursive=discover_recursive)
+    observer.start()
+    return observer
+
+def poll_folder(folder, tracker, snapshot):
+    """Polling fallback: touch files whose size/mtime differ from the previous scan"""
+    seen = {}
+    for path in discover_inputs(folder):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        seen[path] = (st.st_size, st.st_mtime_ns)
+        if snapshot.get(path) != seen[path]:
+            tracker.touch(path)
+    snapshot.clear()
+    snapshot.update(seen)
+
+def process_queued_file(input_path, threads, manifest, queue, settings_hash):
+    """Run one queued path through the manifest-aware pipeline and record the queue status"""
+    try:
+        needed, digest = manifest.check(input_path, settings_hash)
+        if not needed:
+            print(f"⏭️ Unchanged, skipping: {os.path.basename(input_path)}")
+            queue.finish(input_path, "skipped")
+            return
+        success, _ = run_manifest_job(input_path, threads, manifest, digest, settings_hash)
+        queue.finish(input_path, "done" if success else "failed")
+    except OSError as e:
+        logging.error(f"Queued file unavailable {os.path.basename(input_path)}: {e}")
+        queue.finish(input_path, "failed")
+
+def run_watch_daemon():
+    """Watch input_folder and process files as soon as they have finished being written"""
+    if not os.path.exists(input_folder):
+        print(f"❌ Input folder doesn't exist: {input_folder}")
+        return
+    manifest = JobManifest(manifest_path)
+    queue = WorkQueue(manifest_path)
+    settings_hash = settings_fingerprint()
+    resumed = queue.requeue_running()
+    if resumed:
+        print(f"🔁 Re-queued {resumed} files interrupted by the last shutdown")
+
+    tracker = StableFileTracker(watch_stable_seconds)
+    snapshot = {}
+    # Files dropped while the daemon was down
+    poll_folder(input_folder, tracker, snapshot)
+    observer = start_watch_observer(input_folder, tracker)
+    workers, threads = plan_workers(os.cpu_count() or 1)
+    print(f"👀 Watching {input_folder} ({'inotify' if observer else f'polling every {watch_poll_interval}s'}), "
+          f"{workers} workers")
+    if workers > 1:
+        use_job_output()
+
+    stop = threading.Event()
+
+    def worker_loop():
+        while not stop.is_set():
+            input_path = queue.claim()
+            if input_path is None:
+                stop.wait(1)
+                continue
+            process_queued_file(input_path, threads if workers > 1 else 0, manifest, queue, settings_hash)
+
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    # Service managers stop daemons with SIGTERM; shut down the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, on_sigterm)
+    pool = [threading.Thread(target=worker_loop, daemon=True) for _ in range(workers)]
+    for thread in pool:
+        thread.start()
+    last_poll = time.time()
+    try:
+        while True:
+            if observer is None and time.time() - last_poll >= watch_poll_interval:
+                poll_folder(input_folder, tracker, snapshot)
+                last_poll = time.time()
+            for path in tracker.ready():
+                print(f"📥 Queued: {os.path.basename(path)}")
+                queue.put(path)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping watcher (running jobs finish first)...")
+    finally:
+        stop.set()
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        for thread in pool:
+            thread.join()
+        close_probe_cache()
+        queue.close()
+        manifest.close()
+
+class QueueRequestHandler(socketserver.StreamRequestHandler):
+    """JSON-lines protocol over TCP: one request object per line, one reply per line"""
+
+    def handle(self):
+        queue = self.server.queue
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if queue_token is not None and request.get("token") != queue_token:
+                    reply = {"error": "unauthorized"}
+                elif request.get("op") == "claim":
+                    reply = {"path": queue.claim(request["worker"], request.get("lease", lease_seconds))}
+                elif request.get("op") == "heartbeat":
+                    reply = {"ok": queue.heartbeat(request["path"], request["worker"],
+                                                   request.get("lease", lease_seconds))}
+                elif request.get("op") == "finish":
+                    reply = {"ok": queue.finish(request["path"], request["status"], request.get("result"),
+                                                request["worker"])}
+                else:
+                    reply = {"error": f"unknown op {request.get('op')!r}"}
+            except (ValueError, KeyError, sqlite3.Error) as e:
+                reply = {"error": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+def start_queue_server(queue, address):
+    """Serve a WorkQueue on "host:port" from a background thread"""
+    host, _, port = address.rpartition(":")
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer((host or "0.0.0.0", int(port)), QueueRequestHandler)
+    server.daemon_threads = True
+    server.queue = queue
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class RemoteWorkQueue:
+    """Client for start_queue_server with the claim/heartbeat/finish side of WorkQueue"""
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        self.address = (host, int(port))
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def request(self, **payload):
+        if queue_token is not None:
+            payload["token"] = queue_token
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.conn is None:
+                        sock = socket.create_connection(self.address, timeout=30)
+                        self.conn = (sock, sock.makefile("rb"))
+                    self.conn[0].sendall(data)
+                    line = self.conn[1].readline()
+                    if not line:
+                        raise ConnectionError("queue server closed the connection")
+                    break
+                except OSError:
+                    self.close_connection()
+                    if attempt:
+                        raise
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"queue server: {reply['error']}")
+        return reply
+
+    def close_connection(self):
+        if self.conn is not None:
+            self.conn[1].close()
+            self.conn[0].close()
+            self.conn = None
+
+    def claim(self, worker=None, lease=None):
+        return self.request(op="claim", worker=worker, lease=lease)["path"]
+
+    def heartbeat(self, input_path, worker, lease):
+        return self.request(op="heartbeat", path=input_path, worker=worker, lease=lease)["ok"]
+
+    def finish(self, input_path, status, result=None, worker=None):
+        return self.request(op="finish", path=input_path, status=status, result=result, worker=worker)["ok"]
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+
+def open_work_queue(spec):
+    """"tcp://host:port" -> RemoteWorkQueue, anything else is a SQLite file path"""
+    if spec.startswith("tcp://"):
+        return RemoteWorkQueue(spec[len("tcp://"):])
+    return WorkQueue(spec)
+
+def run_coordinator(queue_spec=None, serve=None):
+    """Queue every pending input, hand out leases to workers and record their results in the manifest"""
+    if not os.path.exists(input_folder):
+        print(f"❌ Input folder doesn't exist: {input_folder}")
+        return
+    if queue_spec and queue_spec.startswith("tcp://"):
+        print(f"❌ --queue {queue_spec}: the coordinator owns the queue, so it needs a SQLite path; "
+              f"use --serve HOST:PORT to serve it over TCP")
+        return
+    queue = WorkQueue(queue_spec or shared_queue_path)
+    manifest = JobManifest(manifest_path)
+    settings_hash = settings_fingerprint()
+    serve = serve or queue_serve_address
+    server = start_queue_server(queue, serve) if serve else None
+    digests = {}
+    queued = skipped = 0
+    for input_path in discover_inputs(input_folder):
+        try:
+            needed, digest = manifest.check(input_path, settings_hash) if incremental else (True, None)
+        except OSError as e:
+            logging.error(f"Cannot read {input_path}: {e}")
+            continue
+        if not needed:
+            skipped += 1
+            continue
+        digests[os.path.abspath(input_path)] = digest
+        queue.put(input_path)
+        queued += 1
+    print(f"📋 Coordinator: {queued} queued, {skipped} unchanged"
+          + (f", serving on {serve}" if server else f", queue {queue_spec or shared_queue_path}"))
+
+    totals = {}
+    last_counts = None
+
+    def record_finished():
+        for input_path, status, result in queue.collect_finished():
+            totals[status] = totals.get(status, 0) + 1
+            print(f"{'✅' if status == 'done' else '❌'} {status}: {os.path.basename(input_path)}"
+                  f" ({result.get('worker', '?')}, {result.get('seconds', 0):.1f}s)")
+            if status == "failed":
+                logging.error(f"Worker failed {os.path.basename(input_path)}: {result.get('error')}")
+            try:
+                manifest.mark(input_path, status, digests.get(input_path),
+                              result.get("settings_hash", settings_hash), result.get("output_path"),
+                              result.get("error"))
+            except OSError as e:
+                logging.error(f"Cannot record {input_path}: {e}")
+
+    try:
+        while True:
+            expired = queue.requeue_expired()
+            if expired:
+                print(f"⏰ {expired} leases expired (worker gone?), re-queued")
+            record_finished()
+            counts = queue.counts()
+            if counts != last_counts:
+                print(f"   📊 queued={counts.get('queued', 0)} running={counts.get('running', 0)}")
+                last_counts = counts
+            if not counts.get("queued") and not counts.get("running"):
+                # A job may have finished between collecting and counting
+                record_finished()
+                break
+            time.sleep(queue_poll_interval)
+    except KeyboardInterrupt:
+        print("\n🛑 Coordinator stopped; leased jobs stay in the queue for the next run")
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        queue.close()
+        manifest.close()
+    print("=" * 60)
+    print("🏁 Batch finished: " + ", ".join(f"{k}={v}" for k, v in sorted(totals.items())))
+
+def run_queue_worker(queue_spec=None):
+    """Claim jobs from a shared queue and run them through process_video until stopped (or idle)"""
+    queue = open_work_queue(queue_spec or shared_queue_path)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    settings_hash = settings_fingerprint()
+    workers, threads = plan_workers(os.cpu_count() or 1)
+    print(f"🛠️ Worker {worker_id}: {workers} slots, queue {queue_spec or shared_queue_path}")
+    if workers > 1:
+        use_job_output()
+    held = set()
+    stop = threading.Event()
+
+    def heartbeat_loop():
+        while not stop.wait(heartbeat_interval):
+            for input_path in list(held):
+                try:
+                    if not queue.heartbeat(input_path, worker_id, lease_seconds):
+                        print(f"⚠️ Lease lost: {os.path.basename(input_path)}")
+                except (OSError, RuntimeError, sqlite3.Error) as e:
+                    logging.error(f"Heartbeat failed: {e}")
+
+    def slot_loop():
+        idle_since = time.time()
+        failing_since = None
+        backoff = queue_poll_interval
+        while not stop.is_set():
+            try:
+                input_path = queue.claim(worker_id, lease_seconds)
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                logging.error(f"Claim failed: {e}")
+                failing_since = failing_since or time.time()
+                if time.time() - failing_since > worker_unreachable_exit:
+                    if not stop.is_set():
+                        print(f"🔌 Queue unreachable for {worker_unreachable_exit}s, worker exiting")
+                        stop.set()
+                    return
+                # Back off while the queue is down instead of retrying every poll interval
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            failing_since = None
+            backoff = queue_poll_interval
+            if input_path is None:
+                if worker_idle_exit is not None and time.time() - idle_since > worker_idle_exit:
+                    return
+                stop.wait(queue_poll_interval)
+                continue
+            held.add(input_path)
+            output_path = make_output_path(input_path)
+            try:
+                with job_output(input_path):
+                    success, seconds = process_video(input_path, output_path,
+                                                     threads=threads if workers > 1 else 0)
+            except Exception as e:
+                logging.error(f"Exception processing {os.path.basename(input_path)}: {e}")
+                success, seconds = False, 0
+            status, error = manifest_outcome(input_path, success)
+            held.discard(input_path)
+            result = {"worker": worker_id, "seconds": seconds, "output_path": output_path,
+                      "error": error, "settings_hash": settings_hash}
+            try:
+                if not queue.finish(input_path, status, result, worker_id):
+                    print(f"⚠️ Result dropped, lease was taken over: {os.path.basename(input_path)}")
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                logging.error(f"Reporting {os.path.basename(input_path)} failed: {e}")
+            idle_since = time.time()
+
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+    pool = [threading.Thread(target=slot_loop, daemon=True) for _ in range(workers)]
+    for thread in pool:
+        thread.start()
+    try:
+        for thread in pool:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping worker (running jobs finish first)...")
+        stop.set()
+        for thread in pool:
+            thread.join()
+    finally:
+        stop.set()
+        close_probe_cache()
+        queue.close()
+
+def generate_synthetic_clip(path, width, height, duration):
+    """Create a testsrc2/sine clip for benchmarking (reused if it already exists)"""
+    if os.path.exists(path):
+        return True
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+        "-t", str(duration),
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-y", path,
+    ]
+    return run_ffmpeg(command, timeout=600).returncode == 0
+
+def run_benchmark():
+    """Encode synthetic clips through the CommandBuilder for every codec/preset/filter mode.
+
+    Writes benchmark_results.json and benchmark_results.csv to benchmark_folder.
+    """
+    os.makedirs(benchmark_folder, exist_ok=True)
+    base_config = EncodeConfig.from_globals()
+    rows = []
+    print("🏁 Starting encoder benchmark...")
+    print("=" * 60)
+    for width, height in benchmark_resolutions:
+        for clip_duration in benchmark_durations:
+            clip = os.path.join(benchmark_folder, f"src_{width}x{height}_{clip_duration}s.mp4")
+            if not generate_synthetic_clip(clip, width, height, clip_duration):
+                print(f"❌ Could not generate {os.path.basename(clip)}")
+                continue
+            for codec, encoder, preset in benchmark_modes:
+                for filter_mode, mux_mode in ((f, m) for f in benchmark_filter_modes for m in benchmark_mux_modes):
+                    bench_switches = dict(base_config.switches)
+                    if filter_mode == "none":
+                        for key in FILTER_SWITCHES:
+                            bench_switches[key] = False
+                    config = replace(
+                        base_config,
+                        switches=bench_switches,
+                        video_codec=codec,
+                        prores_encoder=encoder or base_config.prores_encoder,
+                        encoder_preset=preset or base_config.encoder_preset,
+                        mux_mode=mux_mode,
+                    )
+                    mode = f"{encoder or codec}/{preset or '-'}/{filter_mode}/{mux_mode}"
+                    print(f"\n⏱️ {os.path.basename(clip)} → {mode}")
+                    # Same seed per combination so every mode samples the same parameters
+                    rng = random.Random(f"{width}x{height}:{clip_duration}:{filter_mode}")
+                    out = os.path.join(benchmark_folder, "out.mov")
+                    job = resolve_job(config, clip, out, clip_duration, threads=0, rng=rng,
+                                      source_size=(width, height))
+                    command = get_command_builder(config).build(job)
+                    try:
+                        result = run_ffmpeg(command, timeout=3600)
+                    except subprocess.TimeoutExpired:
+                        print("❌ Timeout")
+                        continue
+                    row = {
+                        "source": os.path.basename(clip),
+                        "width": width,
+                        "height": height,
+                        "clip_seconds": clip_duration,
+                        "codec": codec,
+                        "encoder": encoder or "",
+                        "preset": preset or "",
+                        "filters": filter_mode,
+                        "mux_mode": mux_mode,
+                        "returncode": result.returncode,
+                        "encode_seconds": round(result.elapsed, 3),
+                        "peak_rss_kb": result.peak_rss_kb,
+                        "io_read_bytes": result.read_bytes,
+                        "io_write_bytes": result.write_bytes,
+                        "output_bytes": os.path.getsize(out) if os.path.exists(out) else 0,
+                        "fps": None,
+                        "seconds_per_output_minute": None,
+                    }
+                    probe = probe_video(out, use_cache=False) if result.returncode == 0 else None
+                    if probe and probe.duration > 0 and result.elapsed > 0:
+                        frames = int((probe.video or {}).get("nb_frames", 0) or 0)
+                        if frames:
+                            row["fps"] = round(frames / result.elapsed, 2)
+                        row["seconds_per_output_minute"] = round(result.elapsed / (probe.duration / 60), 2)
+                    rows.append(row)
+                    print(f"   fps={row['fps']} s/min={row['seconds_per_output_minute']} "
+                          f"rss={row['peak_rss_kb']}KB size={row['output_bytes']//1024}KB "
+                          f"io={(row['io_read_bytes'] or 0)//1024}KB read/{(row['io_write_bytes'] or 0)//1024}KB written")
+                    if os.path.exists(out):
+                        os.remove(out)
+
+    json_path = os.path.join(benchmark_folder, "benchmark_results.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, indent=2)
+    if rows:
+        csv_path = os.path.join(benchmark_folder, "benchmark_results.csv")
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    print("=" * 60)
+    print(f"🏁 Benchmark complete: {len(rows)} runs → {json_path}")
+    return rows
+
+def time_filter_chain(filter_v, width, height, frames):
+    """Seconds ffmpeg spends running a -vf chain over synthetic frames (decode-free, null output)"""
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30",
+        "-frames:v", str(frames), "-vf", filter_v, "-f", "null", "-",
+    ]
+    result = run_ffmpeg(command, timeout=600)
+    return result.elapsed if result.returncode == 0 else None
+
+def run_filter_benchmark():
+    """Time sampled -vf chains as generated vs. optimized on synthetic frames.
+
+    Writes filter_benchmark.json to benchmark_folder; the baseline is a bare format filter so the
+    per-frame numbers exclude the lavfi source.
+    """
+    os.makedirs(benchmark_folder, exist_ok=True)
+    base_config = EncodeConfig.from_globals()
+    rows = []
+    print("🏁 Starting filter-graph benchmark...")
+    print("=" * 60)
+    for width, height in benchmark_resolutions:
+        baseline = time_filter_chain("format=yuv420p", width, height, benchmark_filter_frames)
+        if baseline is None:
+            print(f"❌ Could not run ffmpeg at {width}x{height}")
+            continue
+        for sample in range(benchmark_filter_samples):
+            seed = f"filters:{width}x{height}:{sample}"
+            plain = resolve_job(replace(base_config, optimize_filters=False), "", "", 30,
+                                rng=random.Random(seed), source_size=(width, height))
+            tuned = resolve_job(base_config, "", "", 30, rng=random.Random(seed), source_size=(width, height))
+            row = {"width": width, "height": height, "sample": sample,
+                   "filter_v": plain.filter_v, "optimized_filter_v": tuned.filter_v}
+            for label, filter_v in (("plain", plain.filter_v), ("optimized", tuned.filter_v)):
+                elapsed = time_filter_chain(filter_v, width, height, benchmark_filter_frames)
+                row[f"{label}_ms_per_frame"] = (
+                    round(max(elapsed - baseline, 0) * 1000 / benchmark_filter_frames, 3)
+                    if elapsed is not None else None)
+            rows.append(row)
+            print(f"   {width}x{height} #{sample}: {row['plain_ms_per_frame']} → "
+                  f"{row['optimized_ms_per_frame']} ms/frame")
+
+    json_path = os.path.join(benchmark_folder, "filter_benchmark.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, indent=2)
+    print("=" * 60)
+    print(f"🏁 Filter benchmark complete: {len(rows)} chains → {json_path}")
+    return rows
 
 def main():
     """Main processing function"""
@@ -502,40 +3476,117 @@ def main():
         print(f"❌ Input folder doesn't exist: {input_folder}")
         return
 
-    video_extensions = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v", ".flv"}
-    video_files = [f for f in os.listdir(input_folder) if Path(f).suffix.lower() in video_extensions]
-
-    if not video_files:
-        print(f"❌ No video files found in {input_folder}")
-        return
-
-    print(f"📁 Found {len(video_files)} video files")
     print(f"🎛️ Active modifications:")
     for key, value in switches.items():
         if value:
             print(f"   ✅ {key}")
     print()
 
+    # Skip inputs already processed with the same content and settings
+    manifest = JobManifest(manifest_path) if incremental and not dry_run else None
+    settings_hash = settings_fingerprint()
+    digests = {}
+    counts = {"found": 0, "skipped": 0}
+
+    def pending_inputs():
+        """Discovered inputs that still need processing, streamed as they are found"""
+        for input_path in discover_inputs(input_folder):
+            counts["found"] += 1
+            if manifest is not None:
+                try:
+                    needed, digest = manifest.check(input_path, settings_hash)
+                except OSError as e:
+                    logging.error(f"Cannot read {input_path}: {e}")
+                    continue
+                digests[input_path] = digest
+                if not needed:
+                    counts["skipped"] += 1
+                    continue
+            yield input_path
+
+    workers, threads = plan_workers(None)
+    if workers > 1:
+        print(f"🧵 Running up to {workers} jobs in parallel, {threads} threads each")
+    if workers > 1 or (async_engine and not dry_run):
+        use_job_output()
+
+    global preset_controller
+    inputs = pending_inputs()
+    if throughput_deadline_seconds is not None or throughput_min_realtime is not None:
+        # A deadline needs the size of the remaining queue, so discovery is completed up front
+        inputs = list(inputs) if throughput_deadline_seconds is not None else inputs
+        preset_controller = PresetController(
+            encoder_preset, workers,
+            total_jobs=len(inputs) if isinstance(inputs, list) else None,
+            deadline=throughput_deadline_seconds,
+            min_realtime=throughput_min_realtime,
+        )
+        target = (f"deadline {throughput_deadline_seconds}s" if throughput_deadline_seconds is not None
+                  else f"≥{throughput_min_realtime}x realtime")
+        print(f"🎚️ Adaptive presets: targeting {target}")
+
     start_total = time.time()
-    for i, filename in enumerate(video_files, 1):
+    if async_engine and not dry_run:
+        print(f"🔀 asyncio engine: starting at {workers} concurrent encodes")
+        results = asyncio.run(run_async_batch(inputs, threads, workers, manifest, settings_hash, digests))
+    elif workers == 1:
+        results = []
+        for i, input_path in enumerate(inputs, 1):
+            print(f"\n[{i}] {os.path.relpath(input_path, input_folder)}")
+            print("-" * 40)
+            results.append((input_path, run_manifest_job(input_path, 0, manifest, digests.get(input_path), settings_hash)))
+            print("-" * 40)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Discovery feeds the pool as files are found, at most a few jobs ahead of the encoders
+            slots = threading.BoundedSemaphore(workers * 4)
+            futures = []
+            for input_path in inputs:
+                slots.acquire()
+                future = executor.submit(run_manifest_job, input_path, threads, manifest,
+                                         digests.get(input_path), settings_hash)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append((input_path, future))
+            # Collect in discovery order so the report matches the input order
+            results = [(input_path, future.result()) for input_path, future in futures]
+
+    for input_path, (success, process_time) in results:
         total_count += 1
-        input_path = os.path.join(input_folder, filename)
-        print(f"\n[{i}/{len(video_files)}] {filename}")
-        print("-" * 40)
-        success, process_time = process_video(input_path, "")
         total_time += process_time
         if success:
             success_count += 1
         else:
-            failed_files.append(filename)
-        print("-" * 40)
+            failed_files.append(os.path.relpath(input_path, input_folder))
 
     total_elapsed = time.time() - start_total
+    close_probe_cache()
+    if manifest is not None:
+        manifest.close()
+
+    if not counts["found"]:
+        print(f"❌ No video files found in {input_folder}")
+        return
+
     print("=" * 60)
     print(f"🎉 ENHANCED STEALTH PROCESSING COMPLETE!")
+    print(f"📁 Found {counts['found']} video files")
     print(f"✅ Success: {success_count}/{total_count} videos")
+    if counts["skipped"]:
+        print(f"⏭️ Skipped (unchanged): {counts['skipped']} videos")
     print(f"⏱️ Total time: {total_elapsed:.1f}s")
     print(f"⚡ Average per video: {total_time/total_count:.1f}s" if total_count > 0 else "")
+    print(f"🧮 Summed per-video time: {total_time:.1f}s")
+    if _stage_totals:
+        print("⏱️ Stage totals: " + ", ".join(f"{k}={v:.1f}s" for k, v in _stage_totals.items()))
+    io_totals = batch_metrics.totals
+    if io_totals["output_bytes"]:
+        mb = 1024 * 1024
+        print(f"💾 I/O ({output_mux_mode}): read {io_totals['io_read_bytes'] / mb:.1f}MB, "
+              f"wrote {io_totals['io_write_bytes'] / mb:.1f}MB for {io_totals['output_bytes'] / mb:.1f}MB of output "
+              f"(model: read {io_totals['io_model_read_bytes'] / mb:.1f}MB, "
+              f"wrote {io_totals['io_model_write_bytes'] / mb:.1f}MB)")
+    if total_elapsed > 0 and workers > 1:
+        print(f"🚀 Parallel speedup: {total_time/total_elapsed:.2f}x with {workers} workers")
     print(f"📁 Output: {output_folder}")
 
     if failed_files:
@@ -544,4 +3595,39 @@ def main():
             print(f"   • {filename}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Fast Instagram stealth video editor")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="benchmark every codec/preset/filter mode on synthetic clips")
+    parser.add_argument("--benchmark-filters", action="store_true",
+                        help="micro-benchmark generated vs. optimized -vf chains on synthetic frames")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the ffmpeg commands without running them")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the batch on the asyncio engine with adaptive concurrency")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process files as they are dropped into the input folder")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="queue pending inputs for --worker processes and collect their results")
+    parser.add_argument("--worker", action="store_true",
+                        help="process jobs claimed from a coordinator's shared queue")
+    parser.add_argument("--queue", metavar="PATH|tcp://HOST:PORT",
+                        help="shared queue: SQLite file on shared storage, or a coordinator's --serve address")
+    parser.add_argument("--serve", metavar="HOST:PORT",
+                        help="coordinator: also serve the queue over TCP")
+    args = parser.parse_args()
+    if args.dry_run:
+        dry_run = True
+    if args.use_async:
+        async_engine = True
+    if args.benchmark:
+        run_benchmark()
+    elif args.benchmark_filters:
+        run_filter_benchmark()
+    elif args.watch:
+        run_watch_daemon()
+    elif args.coordinator:
+        run_coordinator(args.queue, args.serve)
+    elif args.worker:
+        run_queue_worker(args.queue)
+    else:
+        main()
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # main.py creates its output folder and log file relative to the working directory on import
+    monkeypatch.chdir(tmp_path)
+    import main as module
+    return module
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def ops(main):
+    def eq(**values):
+        return main.FilterOp("eq", main.eq_filter_text(values), values)
+
+    def hue(h=0, s=1):
+        return main.FilterOp("hue", f"hue=h={h}:s={s}", {"h": h, "s": s})
+
+    def zoom(factor):
+        return main.FilterOp("zoom", f"scale=iw*{factor}:ih*{factor}", {"factor": factor})
+
+    def resize(width, height):
+        return main.FilterOp("resize", f"scale={width}:{height}", {"width": width, "height": height})
+
+    def crop(identity=False):
+        return main.FilterOp("crop", "crop=iw:ih" if identity else "crop=iw-4:ih-4", {"identity": identity})
+
+    def noise():
+        return main.FilterOp("noise", "noise=alls=2", {})
+
+    return SimpleNamespace(eq=eq, hue=hue, zoom=zoom, resize=resize, crop=crop, noise=noise)
+
+
+def kinds(chain):
+    return [op.kind for op in chain]
+
+
+def test_identity_crop_is_dropped(main, ops):
+    assert kinds(main.optimize_filter_ops([ops.crop(identity=True), ops.noise()])) == ["noise"]
+    assert kinds(main.optimize_filter_ops([ops.crop(), ops.noise()])) == ["crop", "noise"]
+
+
+def test_zoom_before_resize_is_folded_into_it(main, ops):
+    chain = main.optimize_filter_ops([ops.zoom(1.05), ops.noise(), ops.resize(1080, 1920)])
+    assert kinds(chain) == ["noise", "resize"]
+
+
+def test_zoom_after_resize_is_kept(main, ops):
+    chain = main.optimize_filter_ops([ops.resize(1080, 1920), ops.zoom(1.05)])
+    assert kinds(chain) == ["resize", "zoom"]
+
+
+def test_eq_saturation_moves_into_hue(main, ops):
+    chain = main.optimize_filter_ops([ops.eq(brightness=0.02, saturation=1.2), ops.hue(h=3, s=0.9)])
+    eq, hue = chain
+    assert eq.text == "eq=brightness=0.02"
+    assert hue.values == {"h": 3, "s": 1.08}
+
+
+def test_eq_with_only_saturation_disappears(main, ops):
+    chain = main.optimize_filter_ops([ops.eq(saturation=1.2), ops.hue(h=3, s=1)])
+    assert kinds(chain) == ["hue"]
+    assert chain[0].values["s"] == 1.2
+
+
+def test_shrinking_resize_runs_first(main, ops):
+    chain = main.optimize_filter_ops([ops.noise(), ops.resize(720, 1280)], source_size=(1080, 1920))
+    assert kinds(chain) == ["resize", "noise"]
+
+
+def test_growing_resize_stays_last(main, ops):
+    chain = main.optimize_filter_ops([ops.noise(), ops.resize(1080, 1920)], source_size=(720, 1280))
+    assert kinds(chain) == ["noise", "resize"]
+
+
+def test_frame_size_before_follows_zoom_and_resize(main, ops):
+    chain = [ops.zoom(1.1), ops.noise(), ops.resize(720, 1280), ops.noise()]
+    assert main.frame_size_before(chain, 1, (1080, 1920)) == (1188, 2112)
+    assert main.frame_size_before(chain, 3, (1080, 1920)) == (720, 1280)
+
+
+def test_cost_counts_pixels_each_step_sees(main, ops):
+    source = (1000, 1000)
+    assert main.filter_chain_cost([ops.noise()], source) == pytest.approx(2.5)
+    # A resize pays for the larger of its input and output
+    assert main.filter_chain_cost([ops.resize(500, 500), ops.noise()], source) == pytest.approx(1.5 + 2.5 / 4)
+    # eq without saturation only touches luma
+    assert main.filter_chain_cost([ops.eq(brightness=0.1)], source) == pytest.approx(2 / 3)
+
+
+def test_optimized_chain_is_never_more_expensive(main, ops):
+    chain = [ops.crop(identity=True), ops.zoom(1.05), ops.eq(contrast=1.1, saturation=1.3),
+             ops.hue(h=2, s=1), ops.noise(), ops.resize(720, 1280)]
+    source = (1080, 1920)
+    optimized = main.optimize_filter_ops(chain, source)
+    assert main.filter_chain_cost(optimized, source) < main.filter_chain_cost(chain, source)
@@ -0,0 +1,34 @@
+import io
+import threading
+
+
+def test_lines_are_whole_and_labelled(main):
+    stream = io.StringIO()
+    out = main.JobOutput(stream)
+    barrier = threading.Barrier(2)
+
+    def job(name):
+        with main.job_output(f"/in/{name}.mp4"):
+            barrier.wait()
+            for i in range(200):
+                out.write(f"{name} line {i}")
+                out.write("\n")
+
+    threads = [threading.Thread(target=job, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 400
+    for line in lines:
+        label, _, text = line.partition(" ")
+        assert label == f"[{text[0]}.mp4]"
+        assert text.startswith(f"{text[0]} line ")
+
+
+def test_unlabelled_and_blank_lines_pass_through(main):
+    stream = io.StringIO()
+    out = main.JobOutput(stream)
+    out.write("summary\n\n")
+    assert stream.getvalue() == "summary\n\n"
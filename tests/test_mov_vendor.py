@@ -0,0 +1,66 @@
+import io
+import struct
+
+
+def atom(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def sample_entry(kind, vendor):
+    # reserved(6) data_reference_index(2) version(2) revision(2) vendor(4), then codec-specific data
+    return atom(kind, b"\0" * 6 + b"\0\1" + b"\0" * 4 + vendor + b"\0" * 20)
+
+
+def stsd(*entries):
+    return atom(b"stsd", b"\0" * 4 + struct.pack(">I", len(entries)) + b"".join(entries))
+
+
+def track(*entries):
+    return atom(b"trak", atom(b"tkhd", b"\0" * 84)
+                + atom(b"mdia", atom(b"minf", atom(b"stbl", stsd(*entries) + atom(b"stts", b"\0" * 8)))))
+
+
+def movie(*tracks):
+    return atom(b"ftyp", b"qt  \0\0\0\0") + atom(b"mdat", b"\0" * 32) + atom(b"moov", b"".join(tracks))
+
+
+def vendors(main, data):
+    f = io.BytesIO(data)
+    return [data[offset:offset + 4] for offset in main.find_sample_entry_vendor_offsets(f, len(data))]
+
+
+def test_finds_vendor_of_every_track(main):
+    data = movie(track(sample_entry(b"avc1", b"FFMP")), track(sample_entry(b"mp4a", b"FFMP")))
+    assert vendors(main, data) == [b"FFMP", b"FFMP"]
+
+
+def test_stops_at_stsd_entry_count(main):
+    entries = sample_entry(b"avc1", b"FFMP") + sample_entry(b"avc1", b"junk")
+    box = atom(b"stsd", b"\0" * 4 + struct.pack(">I", 1) + entries)
+    data = atom(b"moov", atom(b"trak", atom(b"mdia", atom(b"minf", atom(b"stbl", box)))))
+    assert vendors(main, data) == [b"FFMP"]
+
+
+def test_skips_atoms_outside_the_container_path(main):
+    # An stsd inside mdat or udta is payload, not a sample description
+    data = atom(b"mdat", stsd(sample_entry(b"avc1", b"FFMP"))) + atom(b"moov", atom(b"udta", stsd(
+        sample_entry(b"avc1", b"FFMP"))))
+    assert vendors(main, data) == []
+
+
+def test_extended_size_atom(main):
+    inner = atom(b"trak", atom(b"mdia", atom(b"minf", atom(b"stbl", stsd(sample_entry(b"avc1", b"FFMP"))))))
+    data = struct.pack(">I4sQ", 1, b"moov", 16 + len(inner)) + inner
+    assert vendors(main, data) == [b"FFMP"]
+
+
+def test_entry_cut_off_before_its_vendor_is_skipped(main):
+    data = movie(track(sample_entry(b"avc1", b"FFMP")))
+    assert vendors(main, data[:data.index(b"FFMP") + 2]) == []
+
+
+def test_patch_rewrites_only_matching_vendors(main, tmp_path):
+    path = tmp_path / "out.mov"
+    path.write_bytes(movie(track(sample_entry(b"avc1", b"FFMP")), track(sample_entry(b"mp4a", b"Lavf"))))
+    assert main.patch_mov_vendor(str(path))
+    assert vendors(main, path.read_bytes()) == [b"appl", b"Lavf"]
@@ -0,0 +1,104 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def decoders(main, monkeypatch):
+    monkeypatch.setattr(main, "_decodable_codecs", {"h264", "flv1", "wmv3", "aac"})
+
+
+def video(**extra):
+    stream = {"codec_type": "video", "codec_name": "h264", "width": 1080, "height": 1920,
+              "r_frame_rate": "30/1", "avg_frame_rate": "30/1"}
+    stream.update(extra)
+    return stream
+
+
+def audio(**extra):
+    stream = {"codec_type": "audio", "codec_name": "aac", "sample_rate": "48000"}
+    stream.update(extra)
+    return stream
+
+
+def probe(main, *streams, duration=60.0, size=50_000_000):
+    return main.ProbeResult.from_json({"format": {"duration": str(duration), "size": str(size)},
+                                       "streams": list(streams)})
+
+
+def test_plain_input_passes(main):
+    check = main.preflight_input("in.mp4", probe(main, video(), audio()))
+    assert check.ok
+    assert check.duration == 60.0
+    assert check.has_audio and check.sample_rate == 48000
+    assert check.size == (1080, 1920)
+    assert check.notes == []
+
+
+def test_unreadable_and_videoless_inputs_are_rejected(main):
+    assert main.preflight_input("in.mp4", None).reason == "unreadable (ffprobe failed)"
+    assert main.preflight_input("in.mp4", probe(main, audio())).reason == "no video stream"
+
+
+@pytest.mark.parametrize("codec", ["flv1", "wmv3"])
+def test_any_decodable_codec_is_accepted(main, codec):
+    assert main.preflight_input("in.flv", probe(main, video(codec_name=codec))).ok
+
+
+def test_codec_without_decoder_is_rejected(main):
+    assert main.preflight_input("in.avi", probe(main, video(codec_name="none"))).reason == (
+        "video stream has no decodable codec")
+    assert main.preflight_input("in.avi", probe(main, video(codec_name="cfhd"))).reason == (
+        "no decoder for video codec cfhd")
+
+
+def test_codec_accepted_when_decoder_list_is_unknown(main, monkeypatch):
+    monkeypatch.setattr(main, "_decodable_codecs", set())
+    assert main.preflight_input("in.avi", probe(main, video(codec_name="cfhd"))).ok
+
+
+def test_too_short_input_is_rejected(main):
+    assert not main.preflight_input("in.mp4", probe(main, video(), duration=0.4)).ok
+
+
+def test_streams_are_sized_by_their_own_duration(main):
+    # 10s of 1 Mbit/s video with a 60s 128 kbit/s audio track is ~2.2 MB, not 60s of both
+    streams = (video(bit_rate="1000000", duration="10"), audio(bit_rate="128000", duration="60"))
+    assert main.preflight_input("in.mp4", probe(main, *streams, size=2_300_000)).ok
+    truncated = main.preflight_input("in.mp4", probe(main, *streams, size=600_000))
+    assert truncated.reason.startswith("truncated")
+
+
+def test_stream_without_duration_is_not_sized(main):
+    stream = video(bit_rate="50000000")
+    assert main.preflight_input("in.mp4", probe(main, stream, size=1_000_000)).ok
+
+
+def test_missing_dimensions_are_rejected(main):
+    check = main.preflight_input("in.mp4", probe(main, video(width=0)))
+    assert check.reason == "video stream has no dimensions"
+
+
+def test_rotation_swaps_the_displayed_size(main):
+    rotated = video(width=1920, height=1080, side_data_list=[{"rotation": -90}])
+    check = main.preflight_input("in.mp4", probe(main, rotated))
+    assert check.rotation == 270
+    assert check.size == (1080, 1920)
+
+
+def test_notes_for_vfr_missing_audio_and_odd_sample_rate(main):
+    check = main.preflight_input("in.mp4", probe(main, video(avg_frame_rate="24000/1001")))
+    assert check.vfr
+    assert any("no audio" in note for note in check.notes)
+    check = main.preflight_input("in.mp4", probe(main, video(), audio(sample_rate="22050")))
+    assert any("22050" in note for note in check.notes)
+
+
+def test_rejection_is_retried_when_preflight_settings_change(main, tmp_path, monkeypatch):
+    path = tmp_path / "in.mp4"
+    path.write_bytes(b"x")
+    manifest = main.JobManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.mark(str(path), "rejected", "digest", "settings")
+    assert manifest.check(str(path), "settings") == (False, "digest")
+    assert manifest.check(str(path), "other settings") == (True, "digest")
+    monkeypatch.setattr(main, "preflight_min_duration", 2.0)
+    assert manifest.check(str(path), "settings") == (True, "digest")
+    manifest.close()
@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def sixteen_cpus(main, monkeypatch):
+    monkeypatch.setattr(main, "available_cpus", lambda: 16)
+
+
+def test_no_boost_while_queue_is_longer_than_workers(main):
+    controller = main.PresetController("ultrafast", workers=4, total_jobs=10)
+    assert controller.choose(60, 4) == ("ultrafast", 4)
+
+
+def test_tail_boost_only_hands_out_idle_cores(main):
+    controller = main.PresetController("ultrafast", workers=4, total_jobs=6)
+    for _ in range(4):
+        controller.choose(60, 4)
+    for _ in range(3):
+        controller.release(4)
+    # Three jobs left with one still running on 4 threads: 12 idle cores for the last two
+    assert controller.choose(60, 4) == ("ultrafast", 6)
+    assert controller.held == 10
+
+
+def test_tail_boost_never_shrinks_the_planned_threads(main):
+    controller = main.PresetController("ultrafast", workers=4, total_jobs=3)
+    controller.choose(60, 8)
+    controller.choose(60, 8)
+    assert controller.choose(60, 4) == ("ultrafast", 4)
+
+
+def test_skipped_inputs_leave_the_queue(main):
+    controller = main.PresetController("ultrafast", workers=2, total_jobs=3)
+    controller.skip()
+    controller.skip()
+    # Only one job remains, so it gets every core
+    assert controller.choose(60, 4) == ("ultrafast", 16)
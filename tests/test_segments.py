@@ -0,0 +1,59 @@
+import pytest
+
+
+def job(main, ss=0.0, duration=120.0, framerate=30, filter_a="volume=1.0", remux_codec=None):
+    return main.JobSpec("in.mp4", "out.mov", ss, duration, "format=yuv420p", filter_a, framerate, 3000, 128,
+                        remux_codec=remux_codec)
+
+
+@pytest.fixture(autouse=True)
+def segment_settings(main, monkeypatch):
+    monkeypatch.setattr(main, "segment_parallel", True)
+    monkeypatch.setattr(main, "segment_min_duration", 60)
+    monkeypatch.setattr(main, "segment_target_seconds", 30)
+
+
+def test_segments_cover_the_range_without_gaps(main):
+    segments = main.plan_segments(job(main, ss=2.0), [float(k) for k in range(0, 130, 4)])
+    assert segments[0][0] == 2.0
+    for (start, length), (next_start, _) in zip(segments, segments[1:]):
+        assert start + length == pytest.approx(next_start)
+    end = segments[-1][0] + segments[-1][1]
+    assert end == pytest.approx(122.0)
+
+
+def test_cuts_land_on_the_first_keyframe_past_each_target(main):
+    segments = main.plan_segments(job(main), [0.0, 10.0, 31.0, 45.0, 62.0, 95.0, 110.0])
+    assert [start for start, _ in segments] == [0.0, 31.0, 62.0, 95.0]
+
+
+def test_cuts_snap_to_the_output_frame_grid(main):
+    segments = main.plan_segments(job(main, framerate=25), [30.03, 60.05, 90.01])
+    for start, _ in segments:
+        assert (start * 25) == pytest.approx(round(start * 25))
+
+
+def test_no_cut_in_the_last_half_segment(main):
+    # 110s is within segment_target_seconds / 2 of the end, so it would leave a tiny last segment
+    segments = main.plan_segments(job(main), [31.0, 62.0, 110.0])
+    assert [start for start, _ in segments] == [0.0, 31.0, 62.0]
+
+
+def test_no_plan_without_usable_keyframes(main):
+    assert main.plan_segments(job(main), []) == []
+    assert main.plan_segments(job(main), [5.0, 115.0]) == []
+
+
+def test_should_segment(main):
+    assert main.should_segment([job(main)])
+    assert main.should_segment([job(main, filter_a=None)])  # video-only inputs split too
+    assert not main.should_segment([job(main, duration=30.0)])
+    assert not main.should_segment([job(main, remux_codec="h264")])
+    assert not main.should_segment([job(main), job(main)])
+
+
+def test_video_only_concat_maps_no_audio(main):
+    config = main.EncodeConfig.from_globals()
+    command = main.get_command_builder(config).build_concat(job(main, filter_a=None), "list.txt")
+    assert command.count("-i") == 1
+    assert "1:a:0" not in command
@@ -0,0 +1,82 @@
+import pytest
+
+
+@pytest.fixture
+def queue(main, tmp_path):
+    q = main.WorkQueue(str(tmp_path / "queue.sqlite"))
+    yield q
+    q.close()
+
+
+def put_files(queue, tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(b"x")
+        queue.put(str(path))
+        paths.append(str(path))
+    return paths
+
+
+def test_claim_hands_each_path_to_one_worker(queue, tmp_path):
+    first, second = put_files(queue, tmp_path, "a.mp4", "b.mp4")
+    assert queue.claim("w1", 60) == first
+    assert queue.claim("w2", 60) == second
+    assert queue.claim("w3", 60) is None
+    assert queue.counts() == {"running": 2}
+
+
+def test_heartbeat_and_finish_only_for_lease_holder(queue, tmp_path):
+    (path,) = put_files(queue, tmp_path, "a.mp4")
+    assert queue.claim("w1", 60) == path
+    assert queue.heartbeat(path, "w1", 60)
+    assert not queue.heartbeat(path, "w2", 60)
+    assert not queue.finish(path, "done", {"worker": "w2"}, "w2")
+    assert queue.finish(path, "done", {"worker": "w1"}, "w1")
+    assert not queue.heartbeat(path, "w1", 60)
+    assert queue.counts() == {"done": 1}
+
+
+def test_expired_lease_is_requeued_and_late_result_dropped(queue, tmp_path):
+    (path,) = put_files(queue, tmp_path, "a.mp4")
+    assert queue.claim("w1", -1) == path  # lease already expired
+    assert queue.requeue_expired() == 1
+    assert queue.counts() == {"queued": 1}
+    assert queue.claim("w2", 60) == path
+    assert not queue.finish(path, "done", {"worker": "w1"}, "w1")
+    assert queue.finish(path, "done", {"worker": "w2"}, "w2")
+    assert queue.collect_finished() == [(path, "done", {"worker": "w2"})]
+
+
+def test_expired_lease_fails_after_max_attempts(queue, tmp_path):
+    (path,) = put_files(queue, tmp_path, "a.mp4")
+    for _ in range(2):
+        assert queue.claim("w1", -1) == path
+        queue.requeue_expired(max_attempts=3)
+    assert queue.claim("w1", -1) == path
+    assert queue.requeue_expired(max_attempts=3) == 1
+    assert queue.counts() == {"failed": 1}
+    [(failed_path, status, result)] = queue.collect_finished()
+    assert (failed_path, status) == (path, "failed")
+    assert "lease expired" in result["error"]
+
+
+def test_collect_finished_reports_each_result_once(queue, tmp_path):
+    first, second = put_files(queue, tmp_path, "a.mp4", "b.mp4")
+    queue.claim("w1", 60)
+    queue.claim("w1", 60)
+    queue.finish(first, "done", {"seconds": 1.0}, "w1")
+    assert queue.collect_finished() == [(first, "done", {"seconds": 1.0})]
+    assert queue.collect_finished() == []
+    queue.finish(second, "rejected", {"error": "no video stream"}, "w1")
+    assert queue.collect_finished() == [(second, "rejected", {"error": "no video stream"})]
+
+
+def test_put_requeues_finished_path(queue, tmp_path):
+    (path,) = put_files(queue, tmp_path, "a.mp4")
+    queue.claim("w1", 60)
+    queue.finish(path, "done", {}, "w1")
+    queue.put(path)
+    assert queue.counts() == {"queued": 1}
+    assert queue.collect_finished() == []
+    assert queue.claim("w2", 60) == path